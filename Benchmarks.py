@@ -0,0 +1,379 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+import LevelGenerator
+import Progress
+from Commands import CommandDispatcher
+from GameSession import GameSession, PlayerInfo, levels_to_win
+from GenerationExecutor import generation_executor, SamplingStrategy
+from Messages import (create_level_message, create_packed_level_message, create_lobby_message, create_message,
+                      create_overlay_message, ResultMessage)
+
+# micro benchmarks of the servers hot paths, no sockets involved
+#
+#   python Benchmarks.py --save              measure and keep the results as the baseline
+#   python Benchmarks.py                     measure and compare, exits with 1 if something got slower
+#   python Benchmarks.py --filter leaderboard
+#
+# baselines only mean something on the machine they were measured on
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baseline.json")
+
+# level size ratios (grid_size_y / grid_size_x) of phones in portrait, up to tall ones
+RATIOS = (1.0, 1.6, 2.0)
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # builds the state and returns the function that gets timed, called once per run
+    setup: Callable[[], Callable[[], object]]
+    # calls per timed repetition
+    number: int
+
+
+benchmarks: List[Benchmark] = []
+
+
+def benchmark(name: str, number: int):
+    def register(setup: Callable[[], Callable[[], object]]):
+        benchmarks.append(Benchmark(name, setup, number))
+        return setup
+
+    return register
+
+
+class NullOutbound:
+    # takes the place of an OutboundQueue, frames are thrown away instead of sent
+    closed = False
+
+    def put(self, _message_class, _frame: bytes):
+        pass
+
+    def put_str(self, _message_class, _message: str):
+        pass
+
+    def has_pending(self, _message_class):
+        return False
+
+
+class NullSocket:
+    # for common.SocketWrapper, which sends straight to its socket
+    def __init__(self):
+        self.sent = None
+
+    def send_str(self, message: str):
+        self.sent = message
+
+
+def level_size(level_id: int, ratio: float):
+    grid_size_x, max_effective_moves, _ = LevelGenerator.level_settings(level_id)
+    return grid_size_x, int(grid_size_x * ratio), max_effective_moves
+
+
+# level generation, every run starts from the same random state so they all generate the same levels
+
+def _generator_benchmark(generator_class, level_id: int, ratio: float):
+    grid_size_x, grid_size_y, max_effective_moves = level_size(level_id, ratio)
+
+    def setup():
+        random.seed(level_id)
+        return lambda: generator_class(grid_size_x, grid_size_y, max_effective_moves).generate()
+
+    return setup
+
+
+for _generator_class in (LevelGenerator.Generator, LevelGenerator.NumpyGenerator):
+    for _level_id in range(1, levels_to_win + 1):
+        for _ratio in RATIOS:
+            benchmark(f"{_generator_class.__name__}.generate level {_level_id} ratio {_ratio}", 5)(
+                _generator_benchmark(_generator_class, _level_id, _ratio)
+            )
+
+
+@benchmark("GameSession.get_level all levels best of 8", 1)
+def _get_level():
+    # what a new game costs without a generation pool, every level takes all 8 samples
+    generation_executor.configure(0, strategy=SamplingStrategy(max_samples=8, stop_on_first_optimal=False))
+    random.seed(0)
+
+    async def get_levels():
+        session = GameSession("BENCH")
+        player = PlayerInfo("bench", NullOutbound())
+        player.level_size_ratio = 1.6
+        session.players.add(player)
+        for level_id in range(1, levels_to_win + 1):
+            await session.get_level(level_id)
+
+    def run():
+        # generate_next_level prints a line per level
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(get_levels())
+
+    return run
+
+
+# AnnounceProgress, boards are about half filled like in the middle of a level
+
+def random_board(level_id: int, ratio: float, seed=0):
+    grid_size_x, grid_size_y, _ = level_size(level_id, ratio)
+    tiles = np.random.default_rng(seed).choice(np.array([Progress.EMPTY, Progress.FILLED], dtype=np.uint8),
+                                               grid_size_x * grid_size_y)
+    return grid_size_x, grid_size_y, tiles
+
+
+def progress_message(level_id: int, ratio: float, counts=True, seed=0):
+    grid_size_x, grid_size_y, tiles = random_board(level_id, ratio, seed)
+    packed = LevelGenerator.pack_tiles(tiles)
+    data = f"{grid_size_x};{grid_size_y};{base64.b64encode(packed).decode()}"
+    if counts:
+        empty_count, filled_count = Progress.count_tiles(packed, len(tiles))
+        data += f";{empty_count};{filled_count}"
+    return data
+
+
+def _parse_progress_benchmark(level_id: int, ratio: float, counts: bool, verify: bool):
+    def setup():
+        data = progress_message(level_id, ratio, counts)
+        return lambda: Progress.parse_progress(data, verify)
+
+    return setup
+
+
+for _level_id in (1, levels_to_win):
+    for _ratio in (1.6, 2.0):
+        _size = "{}x{}".format(*level_size(_level_id, _ratio))
+        benchmark(f"parse_progress {_size}", 500)(_parse_progress_benchmark(_level_id, _ratio, True, True))
+        benchmark(f"parse_progress {_size} unverified", 500)(
+            _parse_progress_benchmark(_level_id, _ratio, True, False)
+        )
+        benchmark(f"parse_progress {_size} without counts", 500)(
+            _parse_progress_benchmark(_level_id, _ratio, False, True)
+        )
+
+
+def _patch_benchmark(range_count: int):
+    def setup():
+        board = Progress.ProgressBoard()
+        board.load(Progress.parse_progress(progress_message(levels_to_win, 2.0)))
+        rng = np.random.default_rng(1)
+        offsets = np.sort(rng.choice(len(board.tiles), range_count, replace=False))
+        parts = ";".join(f"{offset},{base64.b64encode(bytes([0b10101010])).decode()}" for offset in offsets)
+
+        def run():
+            # the same delta again and again, only the version has to match
+            board.patch(f"{board.version};{parts}")
+
+        return run
+
+    return setup
+
+
+for _range_count in (1, 16, 128):
+    benchmark(f"ProgressBoard.patch {_range_count} ranges", 500)(_patch_benchmark(_range_count))
+
+
+# leaderboard, one player made progress since the last version
+
+def _leaderboard_benchmark(player_count: int):
+    def setup():
+        session = GameSession("BENCH")
+        rng = random.Random(player_count)
+        # two boards per level to switch between, each update is a new progress message like in a real game
+        reports = {(level_id, seed): Progress.parse_progress(progress_message(level_id, 1.6, seed=seed))
+                   for level_id in range(1, levels_to_win + 1) for seed in range(2)}
+
+        players = []
+        for i in range(player_count):
+            player = PlayerInfo(f"player{i}", NullOutbound())
+            session.players.add(player)
+            player.level = rng.randint(1, levels_to_win)
+            player.level_progress = rng.random()
+            player.progress_board.load(reports[player.level, 0])
+            players.append(player)
+
+        session.leaderboard.add_listener(NullOutbound())
+        session.leaderboard.add_delta_listener(NullOutbound())
+        session.leaderboard.flush()
+
+        def run():
+            player = players[rng.randrange(player_count)]
+            report = reports[player.level, rng.randrange(2)]
+            player.progress_board.load(report)
+            player.level_progress = rng.random()
+            session.update_leaderboard_results()
+            session.leaderboard.flush()
+
+        return run
+
+    return setup
+
+
+for _player_count in (10, 100, 1000):
+    benchmark(f"leaderboard update {_player_count} players", max(10, 1000 // _player_count))(
+        _leaderboard_benchmark(_player_count)
+    )
+
+
+# building messages
+
+@benchmark("dispatch 1000 AnnounceProgress", 20)
+def _dispatch():
+    dispatcher = CommandDispatcher()
+    dispatcher.command("AnnounceProgress")(lambda _context, _data: None)
+    message = "AnnounceProgress:" + progress_message(levels_to_win, 1.6)
+    loop = asyncio.new_event_loop()
+
+    async def dispatch_messages():
+        for _ in range(1000):
+            await dispatcher.dispatch(None, message)
+
+    return lambda: loop.run_until_complete(dispatch_messages())
+
+
+@benchmark("create_level_message", 200)
+def _level_message():
+    grid_size_x, grid_size_y, tiles = random_board(levels_to_win, 2.0)
+    return lambda: create_level_message(8, "Level 8", grid_size_x, 1.0, "".join(str(x) for x in tiles))
+
+
+@benchmark("create_packed_level_message", 2000)
+def _packed_level_message():
+    grid_size_x, grid_size_y, tiles = random_board(levels_to_win, 2.0)
+    return lambda: create_packed_level_message(8, "Level 8", grid_size_x, 1.0, len(tiles), base64.b64encode(
+        LevelGenerator.pack_tiles(tiles)).decode())
+
+
+@benchmark("create_lobby_message 100 players", 2000)
+def _lobby_message():
+    players = [(f"player{i}", i % 3 == 0) for i in range(100)]
+    return lambda: create_lobby_message(players)
+
+
+@benchmark("create_message, create_overlay_message, ResultMessage", 10000)
+def _small_messages():
+    result = ResultMessage("You are #4", "#034", "#cfd")
+
+    def run():
+        create_message("Game over", bg_style="#300", fg_style="#f00")
+        create_overlay_message("  3  ", style="#f88")
+        result.to_message(12)
+
+    return run
+
+
+@benchmark("common.SocketWrapper.send_message", 5000)
+def _socket_wrapper():
+    import common
+
+    wrapper = common.SocketWrapper(NullSocket())
+    level = common.Level(1, "Level 1", "0" * 15 * 24, 15, 1.0)
+    lobby = common.Lobby([common.Lobby.Player(f"player{i}", i % 2 == 0) for i in range(10)])
+
+    def run():
+        wrapper.send_message(lobby)
+        wrapper.send_message(level)
+
+    return run
+
+
+def measure(case: Benchmark, repeat: int) -> float:
+    # seconds per call, the best of all repetitions, everything slower than that is noise from somewhere else
+    run = case.setup()
+    run()
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(case.number):
+            run()
+        best = min(best, (time.perf_counter() - start) / case.number)
+    return best
+
+
+def format_duration(seconds: float):
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:9.2f}ms"
+    return f"{seconds * 1e6:9.2f}us"
+
+
+def load_baseline(path: str) -> Dict[str, float]:
+    try:
+        with open(path) as file:
+            return json.load(file)["results"]
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path: str, results: Dict[str, float]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({"python": sys.version.split()[0], "numpy": np.__version__, "results": results}, file, indent=2)
+        file.write("\n")
+
+
+def run(args) -> int:
+    baseline = load_baseline(args.baseline)
+    saved = dict(baseline)
+    results: Dict[str, float] = {}
+    regressions: List[str] = []
+
+    name_width = max(len(x.name) for x in benchmarks)
+    for case in benchmarks:
+        if args.filter is not None and args.filter not in case.name:
+            continue
+
+        seconds = measure(case, args.repeat)
+        results[case.name] = seconds
+
+        line = f"{case.name:<{name_width}} {format_duration(seconds)}"
+        previous: Optional[float] = baseline.get(case.name)
+        if previous is not None and not args.save:
+            change = seconds / previous - 1
+            line += f"  {change * 100:+6.1f}% of {format_duration(previous).strip()}"
+            if change > args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(case.name)
+        print(line, flush=True)
+
+    if args.save:
+        saved.update(results)
+        save_baseline(args.baseline, saved)
+        print(f"saved {len(results)} results to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print(f"no baseline in {args.baseline}, run with --save to make one")
+    if regressions:
+        print(f"{len(regressions)} benchmarks got more than {args.tolerance * 100:.0f}% slower:")
+        for name in regressions:
+            print("  " + name)
+        return 1
+    return 0
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="benchmark the servers hot paths against a saved baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="json file with the baseline results")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline (merged with the benchmarks that didn't run)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower than the baseline a benchmark may be, 0.25 is 25%%")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="timed repetitions per benchmark, the best one counts")
+    parser.add_argument("--filter", default=None, help="only run benchmarks with this in their name")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(run(create_parser().parse_args()))
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+
+import LevelGenerator
+import Progress
+
+# simulated players that speak the same websocket protocol as the web client, for finding out how many
+# players a server can take before it falls over
+#
+#   python BotSwarm.py --players 200 --leaderboards 5
+#
+# starts a server on a free port, plays one game with all bots and reports latencies and the servers cpu load
+
+
+def percentiles(samples: List[float]):
+    if not samples:
+        return "-"
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+
+    return f"p50 {at(0.5):7.1f}ms  p90 {at(0.9):7.1f}ms  p99 {at(0.99):7.1f}ms  max {samples[-1] * 1000:7.1f}ms"
+
+
+class SwarmStats:
+    def __init__(self):
+        self.round_trips: List[float] = []
+        self.level_latencies: List[float] = []
+        self.leaderboard_staleness: List[float] = []
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.leaderboard_messages = 0
+        self.finished = 0
+        self.disconnected = 0
+        self.errors: List[str] = []
+
+
+class ServerLoad:
+    # cpu time of the server process from /proc, only works for a server started by us on linux
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self.samples: List[float] = []
+        self._last: Optional[tuple] = None
+
+    def _cpu_time(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    async def run(self, interval=1.0):
+        if self.pid is None:
+            return
+
+        while True:
+            cpu_time = self._cpu_time()
+            now = time.perf_counter()
+            if cpu_time is not None and self._last is not None:
+                last_cpu_time, last_time = self._last
+                self.samples.append((cpu_time - last_cpu_time) / (now - last_time))
+            self._last = cpu_time, now
+            await asyncio.sleep(interval)
+
+    def summary(self):
+        if not self.samples:
+            return "n/a"
+        return f"avg {np.mean(self.samples) * 100:.0f}%  max {max(self.samples) * 100:.0f}% of one core"
+
+
+class Bot:
+    def __init__(self, swarm: "Swarm", index: int):
+        self.swarm = swarm
+        self.name = f"bot{index}"
+        self.level_size_ratio = random.choice(swarm.args.ratios)
+        self.rate = swarm.args.progress_rate * random.uniform(0.7, 1.3)
+
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.level_id = 0
+        self.tiles: Optional[np.ndarray] = None
+        self.grid_size_x = 0
+        self.sent_packed: Optional[bytes] = None
+        self.sent_version = 0
+        self.done_sent_at: Optional[float] = None
+        self.pending_pings: Dict[int, float] = {}
+        self.level_received = asyncio.Event()
+        self.finished = asyncio.Event()
+
+    @property
+    def stats(self):
+        return self.swarm.stats
+
+    async def send(self, message: str):
+        await self.ws.send_str(message)
+        self.stats.messages_sent += 1
+
+    async def connect(self, session: aiohttp.ClientSession):
+        # autoping is off so the pongs show up in receive() and can be timed
+        self.ws = await session.ws_connect(f"{self.swarm.ws_url}/ws?lobby={self.swarm.args.lobby}", autoping=False)
+        await self.send(f"RegisterPlayer:{self.name}{{levelSizeRatio={self.level_size_ratio};levelEncoding=packed}}")
+
+    async def receive(self):
+        async for msg in self.ws:
+            if msg.type == aiohttp.WSMsgType.PONG:
+                sent_at = self.pending_pings.pop(struct.unpack("<I", msg.data)[0], None)
+                if sent_at is not None:
+                    self.stats.round_trips.append(time.perf_counter() - sent_at)
+                continue
+            if msg.type == aiohttp.WSMsgType.PING:
+                await self.ws.pong(msg.data)
+                continue
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+
+            self.stats.messages_received += 1
+            command, _, data = msg.data.partition(":")
+
+            if command == "session_token":
+                self.swarm.registered.add(self.name)
+                if len(self.swarm.registered) == len(self.swarm.bots):
+                    self.swarm.all_registered.set()
+            elif command == "level_packed":
+                self.on_level(data)
+            elif command == "progress_resync":
+                self.sent_packed = None
+            elif command == "message":
+                # a result, game over or a rejection, this bot is done either way
+                if not self.finished.is_set():
+                    self.stats.finished += 1
+                    self.finish()
+
+        if not self.finished.is_set():
+            self.stats.disconnected += 1
+            self.finish()
+
+    def finish(self):
+        self.finished.set()
+        self.level_received.set()
+
+    def on_level(self, data: str):
+        level_id, _, grid_size_x, _, tile_count, packed = data.split(";")
+        if self.done_sent_at is not None:
+            self.stats.level_latencies.append(time.perf_counter() - self.done_sent_at)
+            self.done_sent_at = None
+
+        self.level_id = int(level_id)
+        self.grid_size_x = int(grid_size_x)
+        self.tiles = LevelGenerator.unpack_tiles(base64.b64decode(packed), int(tile_count)).copy()
+        self.sent_packed = None
+        self.level_received.set()
+
+    async def ping(self):
+        ping_id = random.getrandbits(32)
+        self.pending_pings[ping_id] = time.perf_counter()
+        await self.ws.ping(struct.pack("<I", ping_id))
+
+    async def send_progress(self):
+        packed = LevelGenerator.pack_tiles(self.tiles)
+        empty_count, filled_count = Progress.count_tiles(packed, len(self.tiles))
+        grid_size_y = len(self.tiles) // self.grid_size_x
+
+        progress = filled_count / (empty_count + filled_count) if empty_count + filled_count > 0 else 0.0
+        self.swarm.expected_progress[self.name] = (self.level_id, progress, time.perf_counter())
+
+        if self.swarm.args.deltas and self.sent_packed is not None and len(self.sent_packed) == len(packed):
+            changed = np.flatnonzero(np.frombuffer(self.sent_packed, np.uint8) != np.frombuffer(packed, np.uint8))
+            ranges = ";".join(f"{i},{base64.b64encode(packed[i:i + 1]).decode()}" for i in changed)
+            await self.send(f"AnnounceProgressDelta:{self.sent_version};{ranges}")
+            self.sent_version += 1
+        else:
+            await self.send(f"AnnounceProgress:{self.grid_size_x};{grid_size_y};"
+                            f"{base64.b64encode(packed).decode()};{empty_count};{filled_count}")
+            self.sent_version = 0
+
+        self.sent_packed = packed
+
+    async def play(self):
+        moves = self.swarm.args.moves_per_level
+        while not self.finished.is_set():
+            await self.level_received.wait()
+            self.level_received.clear()
+            level_id = self.level_id
+
+            unfilled = np.flatnonzero(self.tiles != 2)
+            np.random.shuffle(unfilled)
+            for chunk in np.array_split(unfilled, moves):
+                if self.finished.is_set() or self.level_id != level_id:
+                    break
+
+                await asyncio.sleep(random.expovariate(self.rate))
+                self.tiles[chunk] = 2
+                await self.send_progress()
+                await self.ping()
+
+            if self.finished.is_set():
+                break
+
+            self.done_sent_at = time.perf_counter()
+            await self.send("AnnounceDone:")
+
+
+class Swarm:
+    def __init__(self, args, ws_url: str):
+        self.args = args
+        self.ws_url = ws_url
+        self.stats = SwarmStats()
+        self.bots = [Bot(self, i) for i in range(args.players)]
+        self.registered = set()
+        self.all_registered = asyncio.Event()
+        # bot name -> (level, progress, time it was sent), until a leaderboard shows it
+        self.expected_progress: Dict[str, tuple] = {}
+
+    async def listen_to_leaderboard(self, session: aiohttp.ClientSession, record: bool):
+        ws = await session.ws_connect(f"{self.ws_url}/leaderboard/ws?protocol=delta&lobby={self.args.lobby}")
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+
+            self.stats.leaderboard_messages += 1
+            if not record:
+                continue
+
+            now = time.perf_counter()
+            for _, name, level, progress, _ in json.loads(msg.data)["players"]:
+                expected = self.expected_progress.get(name)
+                if expected is not None and expected[0] == level and expected[1] == progress:
+                    self.stats.leaderboard_staleness.append(now - expected[2])
+                    del self.expected_progress[name]
+
+    async def run(self):
+        # the default connector allows 100 connections, one swarm needs one per bot and leaderboard
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            listeners = [asyncio.ensure_future(self.listen_to_leaderboard(session, i == 0))
+                         for i in range(self.args.leaderboards)]
+
+            await asyncio.gather(*(bot.connect(session) for bot in self.bots))
+            receivers = [asyncio.ensure_future(bot.receive()) for bot in self.bots]
+            try:
+                await asyncio.wait_for(self.all_registered.wait(), 30)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"only {len(self.registered)} of {len(self.bots)} bots got registered") from None
+
+            start = time.perf_counter()
+            await asyncio.gather(*(bot.send("AnnounceReady:") for bot in self.bots))
+
+            try:
+                await asyncio.wait_for(asyncio.gather(*(bot.play() for bot in self.bots)), self.args.timeout)
+            except asyncio.TimeoutError:
+                self.stats.errors.append(f"game didn't end within {self.args.timeout}s")
+            duration = time.perf_counter() - start
+
+            for task in listeners + receivers:
+                task.cancel()
+            for bot in self.bots:
+                await bot.ws.close()
+
+        return duration
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"server didn't come up on port {port}")
+
+
+async def main(args):
+    server = None
+    if args.url is None:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, "main.py", "127.0.0.1", str(port), *args.server_args],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=subprocess.DEVNULL if not args.server_output else None)
+        ws_url = f"http://127.0.0.1:{port}"
+        await wait_for_port(port)
+    else:
+        ws_url = args.url.rstrip("/")
+
+    load = ServerLoad(server.pid if server is not None else None)
+    load_task = asyncio.ensure_future(load.run())
+
+    swarm = Swarm(args, ws_url)
+    try:
+        duration = await swarm.run()
+    finally:
+        load_task.cancel()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    stats = swarm.stats
+    print(f"{args.players} players, {args.leaderboards} leaderboards, game took {duration:.1f}s")
+    print(f"messages        sent {stats.messages_sent}, received {stats.messages_received}, "
+          f"leaderboard {stats.leaderboard_messages}")
+    print(f"round trip      {percentiles(stats.round_trips)}")
+    print(f"next level      {percentiles(stats.level_latencies)}")
+    print(f"leaderboard lag {percentiles(stats.leaderboard_staleness)}")
+    print(f"server cpu      {load.summary()}")
+    print(f"finished        {stats.finished}, disconnected {stats.disconnected}")
+    for error in stats.errors:
+        print("error:", error)
+
+    return stats, load
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="play a game with simulated players against a server")
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--leaderboards", type=int, default=1, help="leaderboard listeners (delta protocol)")
+    parser.add_argument("--progress-rate", type=float, default=2.0, help="progress messages per second per bot")
+    parser.add_argument("--moves-per-level", type=int, default=10, help="progress messages per level")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[1.4, 1.6, 1.8, 2.0],
+                        help="level size ratios the bots pick from")
+    parser.add_argument("--deltas", action="store_true", help="send progress as deltas after the first board")
+    parser.add_argument("--lobby", default="BOTS")
+    parser.add_argument("--timeout", type=float, default=300.0, help="give up on the game after this many seconds")
+    parser.add_argument("--url", default=None,
+                        help="server to test, like http://host:8000 (default: start one on a free port)")
+    parser.add_argument("--server-output", action="store_true", help="show the output of the started server")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="arguments for the started server, after a --")
+    return parser
+
+
+if __name__ == "__main__":
+    _args = create_parser().parse_args()
+    if _args.server_args[:1] == ["--"]:
+        _args.server_args = _args.server_args[1:]
+    asyncio.run(main(_args))
@@ -0,0 +1,39 @@
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from Metrics import metrics
+from OutboundQueue import OutboundQueue, MessageClass, LEVEL, RESULT, MESSAGE, LOBBY, LEADERBOARD, OVERLAY
+
+T = TypeVar("T")
+
+BROADCAST_DURATION = metrics.histogram("colorfill_broadcast_duration_seconds",
+                                       "time spent building, encoding and queueing one broadcast",
+                                       ("message_class",))
+for _message_class in (LEVEL, RESULT, MESSAGE, LOBBY, LEADERBOARD, OVERLAY):
+    BROADCAST_DURATION.labels(_message_class.name)
+
+
+def group_by_payload(recipients: Iterable[Tuple[T, OutboundQueue]],
+                     message: str | Callable[[T], Optional[str]]):
+    groups: Dict[str, List[OutboundQueue]] = {}
+    for recipient, outbound in recipients:
+        if outbound.closed:
+            continue
+
+        payload = message if isinstance(message, str) else message(recipient)
+        if payload is not None:
+            groups.setdefault(payload, []).append(outbound)
+
+    return groups
+
+
+def broadcast(recipients: Iterable[Tuple[T, OutboundQueue]],
+              message: str | Callable[[T], Optional[str]], message_class: MessageClass):
+    # every distinct payload is encoded once, the frames are sent by each connections own writer,
+    # so a slow client only ever delays itself
+    start = time.perf_counter()
+    for payload, queues in group_by_payload(recipients, message).items():
+        frame = payload.encode("utf-8")
+        for outbound in queues:
+            outbound.put(message_class, frame)
+    BROADCAST_DURATION.labels(message_class.name).observe(time.perf_counter() - start)
@@ -1,3 +1,5 @@
+import { Base64Binary } from "./base64-binary";
+
 export type Lobby = {players: {name: string, isReady: boolean}[]}
 export type Level = {id: number, name: string, blocks: number[], width: number, brightness: number}
 export type Message = {str: string, bgFillStyle: string, fgFillStyle: string}
@@ -18,7 +20,13 @@ export class SocketWrapper {
     onLevelRecieved: (level: Level) => void;
     onLobbyRecieved: (lobby: Lobby) => void;
 
-    constructor(private socket: WebSocket) {
+    // the board the server has, progress is sent as a delta against it
+    private sentLevelBytes: Uint8Array = null;
+    private sentLevelWidth = 0;
+    private sentVersion = 0;
+
+    // the server hands out a session token at registration, sending it again gets us our player back after a reload
+    constructor(private socket: WebSocket, private tokenStorageKey: string) {
         let self = this;
         socket.onopen = function() {
             console.log("WebSocket connection established.");
@@ -42,6 +50,10 @@ export class SocketWrapper {
             let match = message.match("^([a-zA-Z0-9_]*):([\\s\\S]*)$");
             
             if (match) {
+                if(match[1] == "level" || match[1] == "level_packed" || match[1] == "progress_resync") {
+                    self.sentLevelBytes = null;
+                }
+
                 if(match[1] == "level") {
                     let parts = match[2].split(";");
                     let id = parseInt(parts[0]);
@@ -56,6 +68,25 @@ export class SocketWrapper {
 
                     self.onLevelRecieved?.({id, name, blocks, width: gridSizeX, brightness});
                 }
+                else if(match[1] == "level_packed") {
+                    let parts = match[2].split(";");
+                    let id = parseInt(parts[0]);
+                    let name = parts[1];
+                    let gridSizeX = parseInt(parts[2]);
+                    let brightness = parseFloat(parts[3]);
+                    let tileCount = parseInt(parts[4]);
+                    let levelBytes = Base64Binary.decode(parts[5]);
+
+                    let blocks = new Array(tileCount);
+                    for (let i = 0; i < tileCount; i++) {
+                        blocks[i] = (levelBytes[i >> 2] >> ((i & 3) * 2)) & 0b11;
+                    }
+
+                    self.onLevelRecieved?.({id, name, blocks, width: gridSizeX, brightness});
+                }
+                else if (match[1] == "session_token") {
+                    sessionStorage.setItem(self.tokenStorageKey, match[2]);
+                }
                 else if (match[1] == "lobby") {
                     let players = [];
                     if (match[2].length > 0) {
@@ -95,7 +126,9 @@ export class SocketWrapper {
     }
 
     public sendRegisterPlayer(name: string, levelSizeRatio: number) {
-        this.socket.send(`RegisterPlayer:${name}{levelSizeRatio=${levelSizeRatio}}`)
+        let token = sessionStorage.getItem(this.tokenStorageKey);
+        let tokenInfo = token != null ? `;token=${token}` : "";
+        this.socket.send(`RegisterPlayer:${name}{levelSizeRatio=${levelSizeRatio};levelEncoding=packed${tokenInfo}}`)
     }
 
     public sendRegisterPlayer_nameOnly(name: string) {
@@ -125,12 +158,63 @@ export class SocketWrapper {
                 compressedLevelBytes[i/4] = byte;
             }
 
+            let emptyCount = 0;
+            let filledCount = 0;
+            for (const block of level.blocks) {
+                if (block == 0) emptyCount++;
+                else if (block == 2) filledCount++;
+            }
+
             let levelHeight = level.blocks.length/level.width; 
-            this.socket.send(`AnnounceProgress:${level.width};${levelHeight};${
-                btoa(String.fromCharCode.apply(null, compressedLevelBytes))
-            }`);
+            let fullBoard = btoa(String.fromCharCode.apply(null, compressedLevelBytes));
+            let delta = this.createProgressDelta(level.width, compressedLevelBytes);
+
+            if (delta == "") {
+                // nothing changed since the last one
+                return;
+            }
+            else if (delta != null && delta.length < fullBoard.length) {
+                this.socket.send(`AnnounceProgressDelta:${this.sentVersion};${delta}`);
+                this.sentVersion++;
+            }
+            else {
+                this.socket.send(`AnnounceProgress:${level.width};${levelHeight};${fullBoard};${emptyCount};${filledCount}`);
+                this.sentVersion = 0;
+            }
+
+            this.sentLevelBytes = compressedLevelBytes;
+            this.sentLevelWidth = level.width;
+        }
+
+    }
+
+    private createProgressDelta(width: number, levelBytes: Uint8Array): string {
+        let sent = this.sentLevelBytes;
+        if (sent == null || width != this.sentLevelWidth || sent.length != levelBytes.length)
+            return null;
+
+        // runs of changed bytes, short gaps are cheaper to resend than to start a new range for
+        let ranges = [];
+        let i = 0;
+        while (i < levelBytes.length) {
+            if (levelBytes[i] == sent[i]) {
+                i++;
+                continue;
+            }
+
+            let start = i;
+            let end = i + 1;
+            for (i = end; i < levelBytes.length && i < end + 8; i++) {
+                if (levelBytes[i] != sent[i])
+                    end = i + 1;
+            }
+            i = end;
+
+            let bytes = levelBytes.subarray(start, end);
+            ranges.push(`${start},${btoa(String.fromCharCode.apply(null, bytes))}`);
         }
 
+        return ranges.join(";");
     }
 
     public unsubscribeAll() {
@@ -0,0 +1,163 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import WSMessage
+
+from Metrics import metrics, Counter, Histogram
+
+# "received ..." lines are debug output, nothing about a message gets formatted unless that level is enabled
+log = logging.getLogger("colorfill.commands")
+
+COMMANDS = metrics.counter("colorfill_commands_total", "websocket commands handled", ("command",))
+# only every TIMING_SAMPLE_RATE-th call of a command is timed, two clock reads and a bisect per message cost
+# more than a lot of the handlers themselves
+TIMING_SAMPLE_RATE = 16
+TIMING_SAMPLE_MASK = TIMING_SAMPLE_RATE - 1
+COMMAND_DURATION = metrics.histogram("colorfill_command_duration_seconds",
+                                     f"time spent handling a websocket command, including awaited work, "
+                                     f"sampled 1 in {TIMING_SAMPLE_RATE}", ("command",))
+COMMAND_ERRORS = metrics.counter("colorfill_command_errors_total", "websocket commands whose handler raised",
+                                 ("command",))
+UNKNOWN_COMMANDS = metrics.counter("colorfill_unknown_commands_total",
+                                   "websocket messages that weren't any known command").labels()
+
+# handler(context, data), may be a coroutine function
+Handler = Callable[[Any, str], Optional[Awaitable[None]]]
+
+
+def message_text(msg: WSMessage) -> Optional[str]:
+    # binary frames carry the same text commands, utf-8 encoded
+    if msg.type == aiohttp.WSMsgType.TEXT:
+        return msg.data
+    if msg.type == aiohttp.WSMsgType.BINARY:
+        try:
+            return msg.data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+def split_command(message: str) -> Tuple[str, str]:
+    # "Command:data", everything after the first ":" belongs to the data, "Command" alone has empty data
+    command, _, data = message.partition(":")
+    return command, data
+
+
+def parse_register_player(data: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    # "name{key=value;key=value}", the name ends at the last "{"
+    if not data.endswith("}") or "\n" in data:
+        return None
+
+    name, separator, extra_infos = data[:-1].rpartition("{")
+    if not separator:
+        return None
+
+    return name, dict(pair.split("=", 1) for pair in extra_infos.split(";") if "=" in pair)
+
+
+class _Command:
+    # everything dispatch needs about a command, behind a single dict lookup
+    __slots__ = ("handler", "count", "duration")
+
+    def __init__(self, name: str, handler: Handler):
+        self.handler = handler
+        self.count: Counter = COMMANDS.labels(name)
+        self.duration: Histogram = COMMAND_DURATION.labels(name)
+        COMMAND_ERRORS.labels(name)
+
+
+class CommandDispatcher:
+    def __init__(self):
+        self.handlers: Dict[str, Handler] = {}
+        self._commands: Dict[str, _Command] = {}
+
+    def command(self, name: str):
+        def register(handler: Handler):
+            self.handlers[name] = handler
+            self._commands[name] = _Command(name, handler)
+            return handler
+
+        return register
+
+    async def dispatch(self, context, message: str):
+        command, data = split_command(message)
+        entry = self._commands.get(command)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("received %s (%d bytes of data) from %s", command, len(data), context)
+
+        if entry is None:
+            UNKNOWN_COMMANDS.inc()
+            return False
+
+        count = entry.count
+        count.value += 1
+        timed = not count.value & TIMING_SAMPLE_MASK
+        start = time.perf_counter() if timed else 0.0
+        try:
+            result = entry.handler(context, data)
+            if result is not None:
+                await result
+        except Exception:
+            COMMAND_ERRORS.labels(command).inc()
+            raise
+        finally:
+            if timed:
+                entry.duration.observe(time.perf_counter() - start)
+        return True
+
+
+def benchmark(message_count=200_000):
+    import asyncio
+    import re
+
+    dispatcher = CommandDispatcher()
+    handled = 0
+
+    @dispatcher.command("AnnounceProgress")
+    def _(_context, _data):
+        nonlocal handled
+        handled += 1
+
+    @dispatcher.command("AnnounceReady")
+    async def _(_context, _data):
+        nonlocal handled
+        handled += 1
+
+    messages = [
+        "AnnounceProgress:32;70;" + "A" * 748 + ";1200;1040",
+        "AnnounceProgress:15;21;" + "qqqq" * 20,
+        "AnnounceReady:",
+        "Unknown:whatever",
+    ]
+
+    async def run():
+        for i in range(message_count):
+            await dispatcher.dispatch(None, messages[i & 3])
+
+    async def run_regex():
+        # what every message went through before
+        for i in range(message_count):
+            match = re.match("^([a-zA-Z0-9_]*):(.*)$", messages[i & 3])
+            if match:
+                command, data = match.groups()
+                handler = dispatcher.handlers.get(command)
+                if handler is not None:
+                    result = handler(None, data)
+                    if result is not None:
+                        await result
+
+    for name, run_messages in (("dispatcher", run), ("regex", run_regex)):
+        handled = 0
+        start = time.perf_counter()
+        asyncio.run(run_messages())
+        duration = time.perf_counter() - start
+
+        print(f"{name}: {message_count} messages ({handled} handled) in {duration * 1000:.1f}ms, "
+              f"{message_count / duration:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Collection, Dict, Optional
+
+from Metrics import metrics
+
+log = logging.getLogger("colorfill.watchdog")
+
+LOOP_LAG = metrics.histogram("colorfill_loop_lag_seconds",
+                             "how much later than scheduled the watchdogs timer ran").labels()
+LOOP_STALLS = metrics.counter("colorfill_loop_stalls_total",
+                              "times the event loop was blocked for longer than the lag threshold").labels()
+
+# frames of a stall report, the innermost ones are the interesting part
+STALL_STACK_LIMIT = 16
+
+MAX_PROFILE_DURATION = 60.0
+
+
+def describe_task(task: Optional[asyncio.Task]):
+    if task is None:
+        return "a plain callback (no task)"
+    coro = task.get_coro()
+    return f"task {task.get_name()!r} running {getattr(coro, '__qualname__', coro)}"
+
+
+class LoopWatchdog:
+    # the loop side ticks every interval and measures how late each tick ran,
+    # a thread notices when the ticks stop coming and takes the stack of the loop thread while it's still stuck,
+    # which is the callback that's blocking everything
+    #
+    # both only wake up once per interval, the threshold by default, that's enough to catch every stall
+    # of twice the threshold and most shorter ones, without keeping an idle server busy
+    def __init__(self, threshold=0.1, interval: Optional[float] = None):
+        self.threshold = threshold
+        self.interval = interval if interval is not None else threshold
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self._last_tick = 0.0
+        self._reported_tick = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+
+    def configure(self, threshold=0.1, interval: Optional[float] = None):
+        self.threshold = threshold
+        self.interval = interval if interval is not None else threshold
+
+    def start(self):
+        if self.threshold <= 0 or self._task is not None:
+            return
+
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = self.loop.create_task(self._tick(), name="loop watchdog")
+        threading.Thread(target=self._watch, name="loop_watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_tick = now
+
+            lag = max(0.0, now - expected)
+            LOOP_LAG.observe(lag)
+            if lag > self.threshold:
+                LOOP_STALLS.inc()
+                log.warning("event loop was blocked for %.0fms", lag * 1000)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            last_tick = self._last_tick
+            stalled_for = time.monotonic() - last_tick - self.interval
+            if stalled_for > self.threshold and last_tick != self._reported_tick:
+                # once per stall, the loop side logs how long it was in the end
+                self._reported_tick = last_tick
+                self.report_stall(stalled_for)
+
+    def report_stall(self, stalled_for: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+
+        # reading the loops current task from here is only a dict lookup, good enough for a report
+        task = asyncio.current_task(self.loop)
+        stack = "".join(traceback.format_stack(frame, STALL_STACK_LIMIT))
+        log.warning("event loop blocked for %.0fms so far, in %s:\n%s", stalled_for * 1000, describe_task(task),
+                    stack.rstrip())
+
+
+watchdog = LoopWatchdog()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, root: Optional[str] = None):
+    # outermost frame first, separated by ";", like flamegraph.pl and speedscope expect it
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    if root is not None:
+        names.append(root)
+    return ";".join(reversed(names))
+
+
+def sample_stacks(thread_ids: Optional[Collection[int]], duration: float, interval=0.005) -> Dict[str, int]:
+    # samples the stacks of the given threads (None: all but this one) until duration is over,
+    # meant to run on a thread of its own while the loop keeps going
+    sampler_id = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    counts: Dict[str, int] = collections.Counter()
+
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            counts[collapse_stack(frame, thread_names.get(thread_id, str(thread_id)))] += 1
+        time.sleep(interval)
+
+    return counts
+
+
+def format_collapsed(counts: Dict[str, int]):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+class Profiler:
+    # one capture at a time, a second request while one is running gets turned away
+    def __init__(self):
+        self.running = False
+
+    async def capture(self, duration: float, interval=0.005, all_threads=False) -> Optional[str]:
+        if self.running:
+            return None
+
+        duration = min(max(duration, 0.0), MAX_PROFILE_DURATION)
+        thread_ids = None if all_threads else {threading.get_ident()}
+
+        self.running = True
+        try:
+            counts = await asyncio.to_thread(sample_stacks, thread_ids, duration, interval)
+        finally:
+            self.running = False
+
+        print(f"captured a {duration:.1f}s profile, {sum(counts.values())} samples")
+        return format_collapsed(counts)
+
+
+profiler = Profiler()
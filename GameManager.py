@@ -0,0 +1,134 @@
+import asyncio
+import os
+import secrets
+import time
+from typing import Callable, Dict, Optional
+
+import Journal
+from GameSession import GameSession
+from LevelLibrary import LevelLibrary
+from Metrics import metrics
+
+# no 0/O and 1/I, codes get read out loud and copied from a projector
+LOBBY_CODE_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+LOBBY_CODE_LENGTH = 5
+MAX_LOBBY_CODE_LENGTH = 16
+
+# a session without any sockets is kept around this long, so players can reload the page and continue
+EMPTY_SESSION_TIMEOUT = 60.0
+
+
+def new_lobby_code():
+    return "".join(secrets.choice(LOBBY_CODE_ALPHABET) for _ in range(LOBBY_CODE_LENGTH))
+
+
+def normalize_lobby_code(code: str) -> Optional[str]:
+    # "" is the default lobby, everything else is case insensitive letters and digits
+    code = code.strip().upper()
+    if len(code) > MAX_LOBBY_CODE_LENGTH or not code.isascii() or not (code.isalnum() or code == ""):
+        return None
+    return code
+
+
+class GameManager:
+    # sessions are created when the first socket for their code connects
+    # and closed once nothing was connected to them for EMPTY_SESSION_TIMEOUT
+    def __init__(self):
+        self.level_library: Optional[LevelLibrary] = None
+        self.consume_library_levels = False
+        self.leaderboard_rate = 10.0
+        # every session keeps a journal in here, None: no journals
+        self.journal_directory: Optional[str] = None
+        self.sessions: Dict[str, GameSession] = {}
+        self._close_handles: Dict[str, asyncio.TimerHandle] = {}
+
+    def configure(self, level_library: Optional[LevelLibrary] = None, consume_library_levels=False,
+                  leaderboard_rate=10.0, journal_directory: Optional[str] = None):
+        self.level_library = level_library
+        self.consume_library_levels = consume_library_levels
+        self.leaderboard_rate = leaderboard_rate
+        self.journal_directory = journal_directory
+
+    def get_or_create_game(self, code: str) -> GameSession:
+        session = self.sessions.get(code)
+        if session is None:
+            journal_path = None
+            if self.journal_directory is not None:
+                journal_path = Journal.journal_path(self.journal_directory, code)
+            session = GameSession(code, self.level_library, self.consume_library_levels, self.leaderboard_rate,
+                                  journal_path)
+            session.start()
+            self.sessions[code] = session
+            print(f"opened {session}")
+        return session
+
+    def close_game(self, code: str):
+        handle = self._close_handles.pop(code, None)
+        if handle is not None:
+            handle.cancel()
+
+        session = self.sessions.pop(code, None)
+        if session is not None:
+            session.close()
+            print(f"closed {session}")
+
+    def connect(self, code: str) -> GameSession:
+        handle = self._close_handles.pop(code, None)
+        if handle is not None:
+            handle.cancel()
+
+        session = self.get_or_create_game(code)
+        session.connection_count += 1
+        return session
+
+    def disconnect(self, session: GameSession):
+        session.connection_count -= 1
+        if session.connection_count == 0 and self.sessions.get(session.code) is session:
+            self._schedule_close(session.code)
+
+    def _schedule_close(self, code: str):
+        self._close_handles[code] = asyncio.get_event_loop().call_later(EMPTY_SESSION_TIMEOUT, self.close_game, code)
+
+    def restore(self, owns_lobby: Callable[[str], bool] = lambda code: True):
+        # rebuilds the sessions of all journals in the journal directory, each one waits for its players
+        # like a session everybody disconnected from
+        if self.journal_directory is None:
+            return
+
+        os.makedirs(self.journal_directory, exist_ok=True)
+        start = time.perf_counter()
+        for file_name in sorted(os.listdir(self.journal_directory)):
+            code = Journal.lobby_code_of(file_name)
+            if code is None or normalize_lobby_code(code) != code or not owns_lobby(code):
+                continue
+
+            path = os.path.join(self.journal_directory, file_name)
+            records = Journal.read_journal(path)
+            if not any(record_type is Journal.REGISTER for record_type, _ in records):
+                os.remove(path)
+                continue
+
+            session = self.get_or_create_game(code)
+            session.restore(records)
+            if session.connection_count == 0:
+                self._schedule_close(code)
+
+        if self.sessions:
+            print(f"restored {len(self.sessions)} sessions in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+game_manager = GameManager()
+
+
+def _live_listeners(session: GameSession):
+    leaderboard = session.leaderboard
+    return sum(not x.closed for x in leaderboard.listeners) + sum(not x.closed for x in leaderboard.delta_listeners)
+
+
+metrics.gauge_function("colorfill_sessions", "open game sessions", lambda: len(game_manager.sessions))
+metrics.gauge_function("colorfill_players", "registered players in all sessions",
+                       lambda: sum(len(x.players) for x in game_manager.sessions.values()))
+metrics.gauge_function("colorfill_leaderboard_listeners", "connected leaderboards in all sessions",
+                       lambda: sum(_live_listeners(x) for x in game_manager.sessions.values()))
+metrics.gauge_function("colorfill_connections", "open player and leaderboard sockets",
+                       lambda: sum(x.connection_count for x in game_manager.sessions.values()))
@@ -1,58 +1,570 @@
-from typing import List, Tuple
+import asyncio
+import base64
+import itertools
+import secrets
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
+import Journal
 import LevelGenerator
-from common import IGameSession, IParticipant, LevelProgress, Level
+import Progress
+from Broadcast import broadcast
+from GenerationExecutor import generation_executor, GenerationStats
+from LeaderboardPublisher import LeaderboardPublisher
+from LevelLibrary import LevelLibrary
+from Metrics import metrics, COUNT_BUCKETS
+from Messages import (create_level_message, create_packed_level_message, create_lobby_message, create_message,
+                      create_overlay_message, ResultMessage)
+from OutboundQueue import OutboundQueue, DetachedOutbound, MessageClass, LEVEL, RESULT, MESSAGE, LOBBY, OVERLAY
+from PlayerRegistry import PlayerRegistry, TrackedPlayer
+from Scheduler import Scheduler
 
-def generate_level(level_id: int, min_ratio: float):
-    grid_size_x = 15 + 5 * (level_id - 1) // 2
-    # grid_size_x = 20 - (level_id - 1)*2
-    # grid_size_x = random.randint(1, 10)*5
-    max_effective_moves = 15 + 5 * (level_id - 1)
-    # brightness = 1.0 - (level_id - 1) / levels_to_win
-    brightness = 1.0
+levels_to_win = 8
 
-    grid_size_y = int(grid_size_x * min_ratio)
+# random bytes in a session token
+TOKEN_BYTES = 16
 
-    samples = [
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-        LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate()
-    ]
+# players restored from the journal are kept this long for their clients to reconnect
+RESUME_TIMEOUT = 60.0
 
-    # get level with the most effective moves
-    level = max(samples, key=lambda x: x[1])[0]
-    level_str = ''.join(str(x) for x in level)
 
-    return Level(level_id, level_str, grid_size_x, brightness)
+class GeneratedLevel(NamedTuple):
+    id: int
+    message: str
+    # same level, but 2-bit packed for clients that registered with levelEncoding=packed
+    packed_message: str
+    grid_size_x: int
+    brightness: float
+    tile_count: int
+    packed: bytes
 
+    def message_for(self, player: "PlayerInfo"):
+        return self.packed_message if player.packed_levels else self.message
 
-class GameSession(IGameSession):
-    def __init__(self):
-        self.participants: List[IParticipant] = []
-        self.levels: List[Level] = []
-        self.min_ratio = float('inf')
 
-    def join(self, participant: IParticipant, level_size_ratio: float):
-        self.min_ratio = min(self.min_ratio, level_size_ratio)
-        self.participants.append(participant)
-        pass
+def build_level(level_id: int, grid_size_x: int, brightness: float, packed: bytes, tile_count: int):
+    # both encodings are built once here, sending a level doesn't touch the tiles anymore
+    level_str = ''.join(str(x) for x in LevelGenerator.unpack_tiles(packed, tile_count))
+    packed_level_str = base64.b64encode(packed).decode()
+    return GeneratedLevel(
+        level_id,
+        create_level_message(level_id, f"Level {level_id}", grid_size_x, brightness, level_str),
+        create_packed_level_message(level_id, f"Level {level_id}", grid_size_x, brightness, tile_count,
+                                    packed_level_str),
+        grid_size_x, brightness, tile_count, packed
+    )
 
-    def leave(self, participant: IParticipant):
-        pass
 
-    def _start_game(self):
-        pass
+player_ids = itertools.count(1)
 
+GENERATION_DURATION = metrics.histogram("colorfill_level_generation_seconds",
+                                        "time the generator spent on a level, all samples together", ("level",))
+GENERATION_SAMPLES = metrics.histogram("colorfill_level_generation_samples",
+                                       "samples generated to find the best level", ("level",), COUNT_BUCKETS)
+LIBRARY_LEVELS = metrics.counter("colorfill_library_levels_total",
+                                 "levels taken from the level library instead of being generated").labels()
+# only the waits for levels the prefetcher didn't have ready yet
+LEVEL_WAIT = metrics.histogram("colorfill_get_level_wait_seconds",
+                               "time a player waited for a level that wasn't generated yet").labels()
+for _level_id in range(1, levels_to_win + 1):
+    GENERATION_DURATION.labels(str(_level_id))
+    GENERATION_SAMPLES.labels(str(_level_id))
 
 
+class PlayerInfo(TrackedPlayer):
+    # level, level_progress, is_ready and result_message are tracked by the sessions PlayerRegistry
+    __slots__ = ("name", "outbound", "level_size_ratio", "progress_board", "packed_levels",
+                 "trusted_progress_counts", "token")
 
-    def announce_level_progress(self, participant: IParticipant, progress: LevelProgress):
-        pass
+    def __init__(self, name: str, outbound: OutboundQueue):
+        super().__init__(next(player_ids))
+        self.name = name
+        self.outbound = outbound
+        self.level_size_ratio = 1.0
+        self.progress_board = Progress.ProgressBoard()
+        self.packed_levels = False
+        # clients that send their own progress counts only get spot checks until they're caught lying
+        self.trusted_progress_counts = True
+        # "slot-secret", handed out at registration, a client that sends it again gets this record back
+        self.token = ""
 
-    def announce_done(self, participant: IParticipant):
-        pass
+    @property
+    def last_progress_message(self):
+        return self.progress_board.message
+
+
+class GameSession:
+    # one lobby, everything a game needs lives in here, so any number of them can run side by side
+    def __init__(self, code: str, level_library: Optional[LevelLibrary] = None, consume_library_levels=False,
+                 leaderboard_rate=10.0, journal_path: Optional[str] = None):
+        self.code = code
+        self.level_library = level_library
+        self.consume_library_levels = consume_library_levels
+
+        self.players: PlayerRegistry[PlayerInfo] = PlayerRegistry()
+
+        self.generated_levels: list[GeneratedLevel] = []
+        self.generated_levels_lock = asyncio.Lock()
+        self.generation_stats: dict[int, GenerationStats] = {}
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.prefetch_ratio: Optional[float] = None
+
+        self.leaderboard = LeaderboardPublisher(self.build_leaderboard_results, leaderboard_rate)
+        self.leaderboard_task: Optional[asyncio.Task] = None
+
+        self.scheduler = Scheduler()
+
+        # open player and leaderboard sockets, the GameManager closes the session once this drops to 0
+        self.connection_count = 0
+
+        self.journal: Optional[Journal.GameJournal] = None
+        if journal_path is not None:
+            self.journal = Journal.GameJournal(journal_path, self.journal_snapshot, self.progress_record)
+
+    def start(self):
+        # named, so the loop watchdog and profiles can tell whose task it is
+        self.leaderboard_task = asyncio.create_task(self.leaderboard.run(), name=f"leaderboard of {self}")
+        if self.journal is not None:
+            self.journal.start()
+
+    def close(self):
+        if self.leaderboard_task is not None:
+            self.leaderboard_task.cancel()
+            self.leaderboard_task = None
+        self.scheduler.cancel_all()
+        self.stop_prefetching()
+        if self.journal is not None:
+            # nobody was left to continue this game
+            self.journal.close(discard=True)
+
+    def __str__(self):
+        return f"lobby {self.code!r}" if self.code else "default lobby"
+
+    def min_level_size_ratio(self):
+        return min(x.level_size_ratio for x in self.players.values())
+
+    async def generate_next_level(self, min_ratio):
+        # only call this while holding generated_levels_lock
+        level_id = len(self.generated_levels) + 1
+        grid_size_x, max_effective_moves, brightness = LevelGenerator.level_settings(level_id)
+        grid_size_y = int(grid_size_x*min_ratio)
+
+        sample = None
+        if self.level_library is not None:
+            sample = self.level_library.take(grid_size_x, grid_size_y, max_effective_moves,
+                                             self.consume_library_levels)
+        if sample is None:
+            sample, stats = await generation_executor.generate(grid_size_x, grid_size_y, max_effective_moves)
+            self.generation_stats[level_id] = stats
+            GENERATION_DURATION.labels(str(level_id)).observe(stats.duration)
+            GENERATION_SAMPLES.labels(str(level_id)).observe(stats.samples)
+            print(f"generated level {level_id} for {self}: {stats}")
+        else:
+            LIBRARY_LEVELS.inc()
+
+        level, _ = sample
+        generated_level = build_level(level_id, grid_size_x, brightness, LevelGenerator.pack_tiles(level), len(level))
+        self.generated_levels.append(generated_level)
+        self.journal_append(self.level_record(generated_level, min_ratio))
+
+    async def get_level(self, level_id):
+        if level_id > len(self.generated_levels):
+            # the prefetcher usually got here first, this only happens if it's still busy
+            start = time.perf_counter()
+            async with self.generated_levels_lock:
+                if level_id > len(self.generated_levels):
+                    await self.generate_next_level(self.min_level_size_ratio())
+                level_id = min(level_id, len(self.generated_levels))
+            LEVEL_WAIT.observe(time.perf_counter() - start)
+
+        return self.generated_levels[level_id - 1]
+
+    async def prefetch_levels(self, min_ratio):
+        for level_id in range(1, levels_to_win + 1):
+            async with self.generated_levels_lock:
+                if level_id > len(self.generated_levels):
+                    await self.generate_next_level(min_ratio)
+
+    def stop_prefetching(self):
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
+        self.prefetch_ratio = None
+
+    def update_prefetching(self):
+        # levels generated for a bigger ratio wouldn't fit on the new players screen,
+        # a bigger ratio is fine though, the levels just don't use all of the screen
+        min_ratio = self.min_level_size_ratio()
+        if self.prefetch_ratio is not None and min_ratio >= self.prefetch_ratio:
+            return
+
+        self.stop_prefetching()
+        self.generated_levels.clear()
+        self.generation_stats.clear()
+        self.journal_append(Journal.LEVELS_RESET.try_encode())
+
+        self.prefetch_ratio = min_ratio
+        self.prefetch_task = asyncio.create_task(self.prefetch_levels(min_ratio), name=f"level prefetch of {self}")
+
+    def send_to_all_players(self, message: str | Callable[[PlayerInfo], Optional[str]],
+                            message_class: MessageClass):
+        player: PlayerInfo
+        for key, player in list(self.players.items()):
+            if player.outbound.closed:
+                print("Closed connection with", player.name)
+                del self.players[key]
+                self.journal_append(Journal.REMOVE.try_encode(key))
+
+        broadcast(((player, player.outbound) for player in self.players.values()), message, message_class)
+
+    def end_game(self):
+        def message(p: PlayerInfo):
+            if p.result_message is not None:
+                return p.result_message.to_message(0)
+            else:
+                return None
+
+        self.send_to_all_players(message, RESULT)
+        self.leaderboard.flush()
+
+        self.scheduler.cancel_all()
+        self.players.clear()
+        self.stop_prefetching()
+        self.generated_levels.clear()
+        self.generation_stats.clear()
+        if self.journal is not None:
+            # the snapshot of a session without players is an empty journal
+            self.journal.compact()
+
+    def build_leaderboard_results(self):
+        info: PlayerInfo
+        return [
+            (info.id, info.name, "F" if info.level == levels_to_win else info.level, info.level_progress,
+             info.last_progress_message)
+            for info in self.players.ranked()
+        ]
+
+    def update_leaderboard_results(self):
+        self.leaderboard.mark_changed()
+
+    def ready_players_count(self):
+        return self.players.ready_count
+
+    def players_done_count(self):
+        return self.players.done_count
+
+    def all_players_ready(self):
+        return 0 < self.ready_players_count() == len(self.players)
+
+    def lobby_message(self, self_p: PlayerInfo):
+        return create_lobby_message(
+            (p.name, p.is_ready) for p in self.players.values() if p is not self_p
+        )
+
+    def player_for_token(self, token: str) -> Optional[PlayerInfo]:
+        slot, _, _ = token.partition("-")
+        if not Progress.is_number(slot):
+            return None
+
+        # compare_digest only takes ascii strs, the token comes straight from the client
+        player_info = self.players.get(int(slot))
+        if player_info is None or not secrets.compare_digest(player_info.token.encode(), token.encode()):
+            return None
+        return player_info
+
+    def journal_append(self, record: Optional[bytes]):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    @staticmethod
+    def register_record(player_info: PlayerInfo) -> Optional[bytes]:
+        return Journal.REGISTER.try_encode(player_info.slot, player_info.level_size_ratio,
+                                           player_info.packed_levels, player_info.token, player_info.name)
+
+    @staticmethod
+    def level_record(level: GeneratedLevel, ratio: float) -> Optional[bytes]:
+        return Journal.LEVEL.try_encode(level.id, level.grid_size_x, level.tile_count, level.brightness, ratio,
+                                        level.packed)
+
+    @staticmethod
+    def progress_record(player_info: PlayerInfo) -> Optional[bytes]:
+        board = player_info.progress_board
+        if not player_info.registered or board.tiles is None:
+            return None
+        return Journal.PROGRESS.try_encode(player_info.slot, player_info.level, player_info.level_progress,
+                                           board.grid_size_x, board.grid_size_y, board.empty_count,
+                                           board.filled_count, bytes(board.tiles))
+
+    def journal_snapshot(self) -> List[bytes]:
+        # the records that rebuild the current state, what a compacted journal consists of
+        records = []
+        if self.generated_levels:
+            ratio = self.prefetch_ratio if self.prefetch_ratio is not None else self.min_level_size_ratio()
+            records.extend(self.level_record(level, ratio) for level in self.generated_levels)
+
+        player_info: PlayerInfo
+        for slot, player_info in self.players.items():
+            records.append(self.register_record(player_info))
+            if player_info.is_ready:
+                records.append(Journal.READY.try_encode(slot))
+            if player_info.level > 0:
+                records.append(Journal.ADVANCE.try_encode(slot, player_info.level))
+            records.append(self.progress_record(player_info))
+            if player_info.result_message is not None:
+                records.append(Journal.RESULT.try_encode(slot, *player_info.result_message))
+        return [record for record in records if record is not None]
+
+    def restore(self, records: List[Journal.Record]):
+        # replays a journal into this (new) session, the players get their slots and tokens back
+        # and continue through the reconnect in register_player
+        ratio = None
+        for record_type, fields in records:
+            if record_type is Journal.REGISTER:
+                slot, level_size_ratio, packed_levels, token, name = fields
+                player_info = self.players.get(slot)
+                if player_info is None:
+                    player_info = PlayerInfo(name, DetachedOutbound(RESUME_TIMEOUT))
+                    self.players.add(player_info, slot)
+                player_info.name = name
+                player_info.token = token
+                player_info.level_size_ratio = level_size_ratio
+                player_info.packed_levels = packed_levels
+                continue
+
+            if record_type is Journal.LEVEL:
+                level_id, grid_size_x, tile_count, brightness, ratio, packed = fields
+                if level_id == len(self.generated_levels) + 1:
+                    self.generated_levels.append(build_level(level_id, grid_size_x, brightness, packed, tile_count))
+                continue
+
+            if record_type is Journal.LEVELS_RESET:
+                self.generated_levels.clear()
+                ratio = None
+                continue
+
+            player_info = self.players.get(fields[0])
+            if player_info is None:
+                continue
+
+            if record_type is Journal.READY:
+                player_info.is_ready = True
+            elif record_type is Journal.ADVANCE:
+                player_info.level = fields[1]
+            elif record_type is Journal.PROGRESS:
+                _, level, level_progress, grid_size_x, grid_size_y, empty_count, filled_count, packed = fields
+                # a progress record can be written after the advance that made it stale
+                if level == player_info.level:
+                    board_message = f"{grid_size_x};{grid_size_y};{base64.b64encode(packed).decode()}"
+                    player_info.progress_board.load(Progress.ProgressReport(
+                        grid_size_x, grid_size_y, board_message, packed, empty_count, filled_count, None
+                    ))
+                    player_info.level_progress = level_progress
+            elif record_type is Journal.RESULT:
+                player_info.level = levels_to_win
+                player_info.level_progress = 1.0
+                player_info.result_message = ResultMessage(*fields[1:])
+            elif record_type is Journal.REMOVE:
+                del self.players[fields[0]]
+
+        if not self.players:
+            return
+
+        if ratio is not None:
+            # the remaining levels get generated for the same ratio, new players don't throw these away either
+            self.prefetch_ratio = ratio
+            self.prefetch_task = asyncio.create_task(self.prefetch_levels(ratio), name=f"level prefetch of {self}")
+
+        if self.players.done_count > 0 and self.players.done_count < len(self.players):
+            # the count down was lost with the old process, the players left get a new one
+            self.start_count_down(5.0, 30)
+
+        self.update_leaderboard_results()
+        print(f"restored {len(self.players)} players and {len(self.generated_levels)} levels of {self}")
+
+    async def register_player(self, outbound: OutboundQueue,
+                              registration: Optional[Tuple[str, Dict[str, str]]]) -> Optional[PlayerInfo]:
+        # registration is the (name, extra infos) from Commands.parse_register_player,
+        # returns the player the connection now belongs to
+        if registration is None:
+            return None
+
+        player_name, extra_infos = registration
+        player_info = self.player_for_token(extra_infos.get("token", ""))
+
+        if player_info is not None:
+            # a reconnect, the old socket is done either way
+            player_info.outbound = outbound
+
+        if player_info is not None and player_info.result_message is not None:
+            outbound.put_str(RESULT, player_info.result_message.to_message(
+                len(self.players) - self.players_done_count()
+            ))
+            return player_info
+
+        if self.all_players_ready() and player_info is not None:
+            player_info.packed_levels = extra_infos.get("levelEncoding") == "packed"
+            level = await self.get_level(max(1, player_info.level))
+            outbound.put_str(LEVEL, level.message_for(player_info))
+            return player_info
+        elif self.all_players_ready() and player_info is None:
+            outbound.put_str(MESSAGE, create_message(
+                "Game already\nin progress",
+                bg_style="#400", fg_style="#fcc"
+            ))
+            return None
+
+        if player_info is None:
+            player_info = PlayerInfo(player_name, outbound)
+            slot = self.players.add(player_info)
+            player_info.token = f"{slot}-{secrets.token_urlsafe(TOKEN_BYTES)}"
+            outbound.put_str(MESSAGE, f"session_token:{player_info.token}")
+        else:
+            player_info.name = player_name
+
+        for key, value in extra_infos.items():
+            if key == "levelSizeRatio":
+                player_info.level_size_ratio = float(value)
+            elif key == "levelEncoding":
+                player_info.packed_levels = value == "packed"
+
+        self.journal_append(self.register_record(player_info))
+        self.update_prefetching()
+
+        self.send_to_all_players(self.lobby_message, LOBBY)
+        return player_info
+
+    async def announce_ready(self, player_info: PlayerInfo):
+        was_all_players_ready = self.all_players_ready()
+        player_info.is_ready = True
+        self.journal_append(Journal.READY.try_encode(player_info.slot))
+
+        if not was_all_players_ready and self.all_players_ready():
+            level = await self.get_level(1)
+            player: PlayerInfo
+
+            self.send_to_all_players(level.message_for, LEVEL)
+
+            for player in self.players.values():
+                player.level = level.id
+                self.journal_append(Journal.ADVANCE.try_encode(player.slot, level.id))
+        else:
+            self.send_to_all_players(self.lobby_message, LOBBY)
+
+    async def announce_done(self, player_info: PlayerInfo):
+        player_info.level += 1
+
+        if player_info.level == levels_to_win+1:
+            player_info.level -= 1
+            player_info.level_progress = 1.0
+
+            players_done = self.players_done_count()
+
+            match players_done:
+                case 0:
+                    player_info.result_message = ResultMessage("You are #1!", "#631", "#fc4")
+
+                    hurry_up_message = create_overlay_message(
+                        f"{player_info.name} is already done\nHurry up!",
+                        display_time=2.0, animation="fly-in"
+                    )
+
+                    def message(p):
+                        if p == player_info:
+                            return None
+                        else:
+                            return hurry_up_message
+
+                    self.send_to_all_players(message, OVERLAY)
+
+                    self.start_count_down(5.0, 30)
+                case 1:
+                    player_info.result_message = ResultMessage("You are #2", "#334", "#eef4ff")
+                case 2:
+                    player_info.result_message = ResultMessage("You are #3", "#521", "#fa7")
+                case _:
+                    player_info.result_message = ResultMessage(f"You are #{players_done + 1}",
+                                                               "#034", "#cfd")
+
+            self.journal_append(Journal.RESULT.try_encode(player_info.slot, *player_info.result_message))
+
+            players_left = len(self.players) - self.players_done_count()
+
+            def message(p: PlayerInfo):
+                if p.result_message is not None:
+                    return p.result_message.to_message(players_left)
+                else:
+                    return None
+
+            self.send_to_all_players(message, RESULT)
+
+            self.update_leaderboard_results()
+
+            if self.players_done_count() == len(self.players):
+                self.end_game()
+
+            return
+
+        self.journal_append(Journal.ADVANCE.try_encode(player_info.slot, player_info.level))
+        level = await self.get_level(player_info.level)
+        player_info.outbound.put_str(LEVEL, level.message_for(player_info))
+
+    def announce_progress(self, player_info: PlayerInfo, data: str):
+        report = Progress.parse_progress(data, verify=Progress.should_verify(player_info.trusted_progress_counts))
+        if report:
+            if report.counts_verified is False:
+                print(f"{player_info.name} sent wrong progress counts, checking all of them from now on")
+                player_info.trusted_progress_counts = False
+
+            player_info.progress_board.load(report)
+            player_info.level_progress = report.progress
+
+            self.update_leaderboard_results()
+            if self.journal is not None:
+                self.journal.progress(player_info.slot, player_info)
+
+    def announce_progress_delta(self, player_info: PlayerInfo, data: str):
+        board = player_info.progress_board
+        if board.patch(data):
+            player_info.level_progress = board.progress
+
+            self.update_leaderboard_results()
+            if self.journal is not None:
+                self.journal.progress(player_info.slot, player_info)
+        elif not board.resync_requested:
+            board.resync_requested = True
+            player_info.outbound.put_str(MESSAGE, "progress_resync:")
+
+    def send_to_waiting_players(self, message: str, message_class: MessageClass):
+        # everyone still playing gets the same frame
+        broadcast(((p, p.outbound) for p in self.players.values() if p.result_message is None),
+                  message, message_class)
+
+    def start_count_down(self, delay, number=30):
+        # every tick is scheduled up front at its absolute time, end_game cancels whatever is left
+        start = self.scheduler.now() + delay
+
+        def tick(message: str):
+            return lambda: self.send_to_waiting_players(message, OVERLAY)
+
+        seconds_left = number
+        while seconds_left > 10:
+            self.scheduler.at(start + number - seconds_left, tick(create_overlay_message(
+                f"{seconds_left} seconds left!", display_time=2.0, animation="fly-in"
+            )))
+            seconds_left -= 10
+
+        while seconds_left > 0:
+            if seconds_left <= 3:
+                overlay_message = create_overlay_message(f"  {seconds_left}  ", style="#f88")
+            else:
+                overlay_message = create_overlay_message(f"   {seconds_left}   ")
+
+            self.scheduler.at(start + number - seconds_left, tick(overlay_message))
+            seconds_left -= 1
+
+        self.scheduler.at(start + number, self.time_up)
+
+    def time_up(self):
+        self.send_to_waiting_players(create_message("Game over", bg_style="#300", fg_style="#f00"), RESULT)
+
+        self.end_game()
@@ -0,0 +1,175 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, List, Tuple, NamedTuple
+
+import LevelGenerator
+
+
+def reseed():
+    # forked workers inherit the random state of the server process,
+    # without this every worker would produce the exact same samples
+    random.seed()
+
+
+def _exit_with_parent(parent_pid):
+    # pool workers don't notice when the server gets killed, they would keep running forever
+    while os.getppid() == parent_pid:
+        time.sleep(1.0)
+    os._exit(0)
+
+
+def watch_parent(parent_pid):
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+
+
+def init_worker(parent_pid):
+    reseed()
+    watch_parent(parent_pid)
+
+
+def generate_sample(grid_size_x: int, grid_size_y: int, max_effective_moves: int) -> Tuple[List[int], int]:
+    return LevelGenerator.NumpyGenerator(grid_size_x, grid_size_y, max_effective_moves).generate()
+
+
+class SamplingStrategy(NamedTuple):
+    max_samples: int = 8
+    # accept a sample once it has this fraction of max_effective_moves (None: only max_samples counts)
+    target_quality: Optional[float] = None
+    # stop taking new samples after this many seconds, as long as there is at least one
+    time_budget: Optional[float] = None
+    # a sample that reached max_effective_moves can't be beaten by any other sample
+    stop_on_first_optimal: bool = True
+
+    def is_good_enough(self, effective_moves: int, max_effective_moves: int):
+        if self.stop_on_first_optimal and effective_moves >= max_effective_moves:
+            return True
+        return self.target_quality is not None and effective_moves >= self.target_quality * max_effective_moves
+
+
+class GenerationStats(NamedTuple):
+    samples: int
+    effective_moves: int
+    max_effective_moves: int
+    duration: float
+
+    def __str__(self):
+        return f"{self.effective_moves}/{self.max_effective_moves} effective moves, " \
+               f"{self.samples} samples in {self.duration * 1000:.1f}ms"
+
+
+def generate_best_sample(grid_size_x: int, grid_size_y: int, max_effective_moves: int,
+                         strategy=SamplingStrategy()):
+    start = time.perf_counter()
+    best = None
+    samples = 0
+
+    while samples < strategy.max_samples:
+        sample = generate_sample(grid_size_x, grid_size_y, max_effective_moves)
+        samples += 1
+
+        # get level with the most effective moves
+        if best is None or sample[1] > best[1]:
+            best = sample
+
+        if strategy.is_good_enough(best[1], max_effective_moves):
+            break
+        if strategy.time_budget is not None and time.perf_counter() - start >= strategy.time_budget:
+            break
+
+    return best, GenerationStats(samples, best[1], max_effective_moves, time.perf_counter() - start)
+
+
+class GenerationExecutor:
+    def __init__(self, workers: Optional[int] = None, use_threads=False, strategy=SamplingStrategy()):
+        # workers=None uses one worker per core, workers=0 generates on the calling thread
+        self.workers = workers
+        self.use_threads = use_threads
+        self.strategy = strategy
+        self._executor: Optional[Executor] = None
+
+    def configure(self, workers: Optional[int] = None, use_threads=False, strategy=SamplingStrategy()):
+        self.shutdown()
+        self.workers = workers
+        self.use_threads = use_threads
+        self.strategy = strategy
+
+    def start(self):
+        if self._executor is not None or self.workers == 0:
+            return
+
+        if self.use_threads:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="level_generator")
+        else:
+            # forked workers would inherit the servers listening socket and keep it open after the server exits
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=init_worker, initargs=(os.getpid(),),
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self, wait=False):
+        # wait: also wait for the samples that are already being generated, a process that's about to exit has to,
+        # or it hangs joining its unfinished workers
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    async def generate(self, grid_size_x: int, grid_size_y: int, max_effective_moves: int,
+                       strategy: Optional[SamplingStrategy] = None):
+        strategy = strategy or self.strategy
+
+        if self.workers == 0:
+            return generate_best_sample(grid_size_x, grid_size_y, max_effective_moves, strategy)
+
+        self.start()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = None if strategy.time_budget is None else start + strategy.time_budget
+
+        # only keep as many samples in flight as there are workers,
+        # everything queued behind them would be wasted once a sample is good enough
+        window = self.workers or os.cpu_count() or 1
+        pending = set()
+        submitted = 0
+        samples = 0
+        best = None
+
+        try:
+            while True:
+                while submitted < strategy.max_samples and len(pending) < window:
+                    pending.add(loop.run_in_executor(self._executor, generate_sample,
+                                                     grid_size_x, grid_size_y, max_effective_moves))
+                    submitted += 1
+
+                if not pending:
+                    break
+
+                timeout = None
+                if deadline is not None and best is not None:
+                    timeout = max(deadline - loop.time(), 0)
+
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                for future in done:
+                    sample = future.result()
+                    samples += 1
+
+                    # get level with the most effective moves
+                    if best is None or sample[1] > best[1]:
+                        best = sample
+
+                if strategy.is_good_enough(best[1], max_effective_moves):
+                    break
+                if deadline is not None and loop.time() >= deadline:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+
+        return best, GenerationStats(samples, best[1], max_effective_moves, loop.time() - start)
+
+
+generation_executor = GenerationExecutor()
@@ -0,0 +1,281 @@
+import asyncio
+import mmap
+import os
+import struct
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# an append-only file per lobby with the state transitions of its game, after a restart the sessions are
+# rebuilt from it and the players continue with their session tokens
+#
+# file: MAGIC, then records of
+#   payload length (u32), record type (u8), payload, crc32 of type and payload (u32)
+# payload: the fixed fields of the record type, then its text and byte fields, each with a u32 length
+# a record that got cut off or doesn't match its crc ends the journal, that's where the last write was torn
+# floats are stored as doubles, a ratio has to come back exactly as the client sent it to still match
+MAGIC = b"CFJ\x02"
+HEADER = struct.Struct("<IB")
+LENGTH = struct.Struct("<I")
+CRC = struct.Struct("<I")
+
+# seconds between batches, every batch is one write and one fsync on a worker thread
+FLUSH_INTERVAL = 0.5
+# a journal this big gets replaced by a snapshot of the current state
+COMPACT_SIZE = 16 << 20
+
+
+class RecordType:
+    def __init__(self, code: int, name: str, fixed: str, variable=""):
+        self.code = code
+        self.name = name
+        self.fixed = struct.Struct("<" + fixed)
+        self.fixed_count = len(self.fixed.unpack(bytes(self.fixed.size)))
+        # "s" for a text field, "b" for a bytes field
+        self.variable = variable
+
+    def __repr__(self):
+        return self.name
+
+    def encode(self, *fields) -> bytes:
+        parts = [self.fixed.pack(*fields[:self.fixed_count])]
+        for kind, value in zip(self.variable, fields[self.fixed_count:]):
+            data = value.encode("utf-8") if kind == "s" else value
+            parts.append(LENGTH.pack(len(data)))
+            parts.append(data)
+        payload = b"".join(parts)
+        crc = zlib.crc32(payload, zlib.crc32(bytes((self.code,))))
+        return HEADER.pack(len(payload), self.code) + payload + CRC.pack(crc)
+
+    def try_encode(self, *fields) -> Optional[bytes]:
+        # a record with values that don't fit its fields is left out, instead of failing whatever wrote it
+        try:
+            return self.encode(*fields)
+        except struct.error as e:
+            print(f"left a {self.name} record out of the journal: {e}")
+            return None
+
+    def decode(self, buffer, offset: int) -> Tuple:
+        fields = list(self.fixed.unpack_from(buffer, offset))
+        offset += self.fixed.size
+        for kind in self.variable:
+            length, = LENGTH.unpack_from(buffer, offset)
+            offset += LENGTH.size
+            data = buffer[offset:offset + length]
+            offset += length
+            fields.append(data.decode("utf-8") if kind == "s" else data)
+        return tuple(fields)
+
+
+# slot, level size ratio, packed levels, token, name
+REGISTER = RecordType(1, "register", "Hd?", "ss")
+# slot
+READY = RecordType(2, "ready", "H")
+# level id, grid size x, tile count, brightness, level size ratio it was generated for, packed tiles
+LEVEL = RecordType(3, "level", "HHIdd", "b")
+# the generated levels were thrown away
+LEVELS_RESET = RecordType(4, "levels_reset", "")
+# slot, level
+ADVANCE = RecordType(5, "advance", "HH")
+# slot, level, level progress, grid size x, grid size y, empty count, filled count, packed board
+PROGRESS = RecordType(6, "progress", "HHdHHII", "b")
+# slot, message, background style, foreground style
+RESULT = RecordType(7, "result", "H", "sss")
+# slot
+REMOVE = RecordType(8, "remove", "H")
+
+RECORD_TYPES = {x.code: x for x in (REGISTER, READY, LEVEL, LEVELS_RESET, ADVANCE, PROGRESS, RESULT, REMOVE)}
+
+Record = Tuple[RecordType, Tuple]
+
+
+def decode_records(buffer, size: int) -> Tuple[List[Record], int]:
+    # (records, length of the intact part)
+    if size < len(MAGIC) or buffer[:len(MAGIC)] != MAGIC:
+        return [], 0
+
+    records = []
+    offset = len(MAGIC)
+    while offset + HEADER.size <= size:
+        length, code = HEADER.unpack_from(buffer, offset)
+        payload_start = offset + HEADER.size
+        end = payload_start + length + CRC.size
+        record_type = RECORD_TYPES.get(code)
+        if record_type is None or end > size:
+            break
+
+        crc, = CRC.unpack_from(buffer, end - CRC.size)
+        if crc != zlib.crc32(buffer[payload_start:end - CRC.size], zlib.crc32(bytes((code,)))):
+            break
+
+        records.append((record_type, record_type.decode(buffer, payload_start)))
+        offset = end
+
+    return records, offset
+
+
+def read_journal(path: str) -> List[Record]:
+    # the file is mapped instead of read, only the records' byte fields get copied out
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            records, intact = decode_records(buffer, size)
+
+    if intact < size:
+        print(f"ignored {size - intact} bytes at the end of {path}")
+    return records
+
+
+def journal_path(directory: str, code: str):
+    return os.path.join(directory, f"lobby-{code}.journal")
+
+
+def lobby_code_of(file_name: str) -> Optional[str]:
+    if file_name.startswith("lobby-") and file_name.endswith(".journal"):
+        return file_name[len("lobby-"):-len(".journal")]
+    return None
+
+
+class GameJournal:
+    # the journal of one session, records are collected on the loop and written in batches by a worker thread,
+    # a batch is written and fsync'd before the next one starts
+    #
+    # progress is the bulk of it and only the latest one per player matters, so it's kept by slot and
+    # only turned into a record when a batch is written, or when another record has to come after it
+    def __init__(self, path: str, snapshot: Callable[[], List[bytes]],
+                 progress_record: Callable[[Any], Optional[bytes]], flush_interval=FLUSH_INTERVAL,
+                 compact_size=COMPACT_SIZE):
+        self.path = path
+        self.snapshot = snapshot
+        self.progress_record = progress_record
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+
+        self._buffer = bytearray()
+        self._pending_progress: Dict[int, Any] = {}
+        # the first batch always starts a new file, whatever was there before is either restored already or stale
+        self._replace = True
+        self._size = 0
+        self._changed = asyncio.Event()
+        self._closing = False
+        self._discard = False
+        self._task: Optional[asyncio.Task] = None
+
+        # only touched by the worker thread
+        self._file = None
+        # (device, inode) of the file this journal wrote, a new session of the same lobby replaces it with its own
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._temporary_path = f"{path}.{os.getpid()}-{id(self):x}.tmp"
+
+    def start(self):
+        self._changed.set()
+        self._task = asyncio.create_task(self.run(), name=f"journal {os.path.basename(self.path)}")
+
+    def append(self, record: Optional[bytes]):
+        # None is a record that couldn't be encoded, see RecordType.try_encode
+        self._collect_progress()
+        if record is not None:
+            self._buffer += record
+        self._changed.set()
+
+    def progress(self, slot: int, player):
+        self._pending_progress[slot] = player
+        self._changed.set()
+
+    def compact(self):
+        # the next batch replaces the file with a snapshot, everything collected until then is part of it
+        self._replace = True
+        self._changed.set()
+
+    def close(self, discard=False):
+        # the last batch still gets written, or with discard the file gets deleted
+        self._closing = True
+        self._discard = discard
+        self._changed.set()
+
+    def _collect_progress(self):
+        for player in self._pending_progress.values():
+            try:
+                record = self.progress_record(player)
+            except struct.error as e:
+                print(f"left a progress record out of {self.path}: {e}")
+                continue
+            if record is not None:
+                self._buffer += record
+        self._pending_progress.clear()
+
+    async def run(self):
+        while not self._closing:
+            await self._changed.wait()
+            self._changed.clear()
+            await self.flush()
+            await asyncio.sleep(self.flush_interval)
+
+        if self._discard:
+            await asyncio.to_thread(self._delete)
+        else:
+            await self.flush()
+            await asyncio.to_thread(self._close_file)
+
+    async def flush(self):
+        try:
+            if self._replace:
+                self._replace = False
+                self._buffer.clear()
+                self._pending_progress.clear()
+                data = MAGIC + b"".join(self.snapshot())
+                self._size = len(data)
+                replace = True
+            else:
+                self._collect_progress()
+                if not self._buffer:
+                    return
+                data = bytes(self._buffer)
+                self._buffer.clear()
+                self._size += len(data)
+                replace = False
+                if self._size > self.compact_size:
+                    self.compact()
+
+            await asyncio.to_thread(self._write, data, replace)
+        except OSError as e:
+            # a batch may have been written halfway, the next one starts over with a snapshot
+            print(f"couldn't write {self.path}: {e}")
+            self.compact()
+        except Exception as e:
+            # same, whatever went wrong must not end the journal task and with it all further batches
+            print(f"couldn't write {self.path}: {e!r}")
+            self.compact()
+
+    def _write(self, data: bytes, replace: bool):
+        if replace:
+            with open(self._temporary_path, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+                stat = os.fstat(file.fileno())
+            self._close_file()
+            os.replace(self._temporary_path, self.path)
+            self._file_id = (stat.st_dev, stat.st_ino)
+            self._file = open(self.path, "ab")
+            return
+
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _delete(self):
+        self._close_file()
+        # the lobby may have been opened again in the meantime, the file at the path is then the new sessions
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self._file_id == (stat.st_dev, stat.st_ino):
+            os.remove(self.path)
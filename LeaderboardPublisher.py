@@ -0,0 +1,135 @@
+import asyncio
+import json
+from typing import Callable, List, Optional, Tuple
+
+from Broadcast import broadcast
+from Metrics import metrics, SIZE_BUCKETS
+from OutboundQueue import OutboundQueue, LEADERBOARD
+
+LEADERBOARD_PUBLISHES = metrics.counter("colorfill_leaderboard_publishes_total",
+                                        "leaderboard versions built and sent to listeners").labels()
+# json.dumps escapes everything to ascii, so the length of the json is its size in bytes
+LEADERBOARD_FRAME_SIZE = metrics.histogram("colorfill_leaderboard_frame_bytes",
+                                           "size of the leaderboard frames, once per published version",
+                                           ("kind",), SIZE_BUCKETS)
+FULL_FRAME_SIZE = LEADERBOARD_FRAME_SIZE.labels("full")
+PATCH_FRAME_SIZE = LEADERBOARD_FRAME_SIZE.labels("patch")
+
+# (player id, name, level, level progress, last progress message), the same id always means the same player
+Row = Tuple[int, str, int | str, float, str]
+
+
+class LeaderboardPublisher:
+    # there are two kinds of listeners:
+    # - listeners get the full results as a json list of [name, level, progress, progress message] on every change
+    # - delta listeners get a snapshot once, then patches with only the players that changed:
+    #   {"type": "snapshot", "version": v, "players": [row, ...]}
+    #   {"type": "patch", "version": v, "base": v-1, "players": [changed row, ...], "removed": [id, ...],
+    #    "order": [id, ...] (only if the ranking changed)}
+    #   a delta listener that gets a patch for a base it doesn't have sends "resync" and gets a new snapshot
+    #
+    # build_rows is only called once per published version, no matter how many changes came in since the last one
+    def __init__(self, build_rows: Callable[[], List[Row]], max_rate=10.0):
+        self.build_rows = build_rows
+        self.min_interval = 1.0 / max_rate
+        self.listeners: list[OutboundQueue] = []
+        self.delta_listeners: list[OutboundQueue] = []
+
+        self.version = 0
+        self.published_version = 0
+        self.delta_version = 0
+
+        self.rows: List[Row] = []
+        self._rows_by_id = {}
+        self._results_json: Optional[str] = None
+        self._snapshot_json: Optional[str] = None
+
+        self._changed = asyncio.Event()
+
+    def mark_changed(self):
+        self.version += 1
+        self._changed.set()
+
+    @property
+    def results_json(self):
+        if self._results_json is None:
+            self._results_json = json.dumps([row[1:] for row in self.rows])
+        return self._results_json
+
+    @property
+    def snapshot_json(self):
+        if self._snapshot_json is None:
+            self._snapshot_json = json.dumps({"type": "snapshot", "version": self.delta_version, "players": self.rows})
+        return self._snapshot_json
+
+    def add_listener(self, outbound: OutboundQueue):
+        self.listeners.append(outbound)
+        if self.published_version > 0:
+            outbound.put_str(LEADERBOARD, self.results_json)
+
+    def add_delta_listener(self, outbound: OutboundQueue):
+        self.delta_listeners.append(outbound)
+        self.resync(outbound)
+
+    def resync(self, outbound: OutboundQueue):
+        outbound.put_str(LEADERBOARD, self.snapshot_json)
+
+    def flush(self):
+        # publishes pending changes right away, for when the state is about to go away
+        if self.published_version == self.version:
+            return
+
+        self.published_version = self.version
+        LEADERBOARD_PUBLISHES.inc()
+
+        rows = self.build_rows()
+        rows_by_id = {row[0]: row for row in rows}
+
+        changed = [row for row in rows if self._rows_by_id.get(row[0]) != row]
+        removed = [player_id for player_id in self._rows_by_id if player_id not in rows_by_id]
+        order = [row[0] for row in rows]
+        order_changed = order != [row[0] for row in self.rows]
+
+        self.rows = rows
+        self._rows_by_id = rows_by_id
+        self._results_json = None
+        self._snapshot_json = None
+
+        self.listeners[:] = [x for x in self.listeners if not x.closed]
+        self.delta_listeners[:] = [x for x in self.delta_listeners if not x.closed]
+
+        if self.listeners:
+            FULL_FRAME_SIZE.observe(len(self.results_json))
+            broadcast(((listener, listener) for listener in self.listeners), self.results_json, LEADERBOARD)
+
+        if not (changed or removed or order_changed):
+            return
+
+        self.delta_version += 1
+        if not self.delta_listeners:
+            return
+
+        patch = {"type": "patch", "version": self.delta_version, "base": self.delta_version - 1,
+                 "players": changed, "removed": removed}
+        if order_changed:
+            patch["order"] = order
+        patch_frame = json.dumps(patch).encode("utf-8")
+        PATCH_FRAME_SIZE.observe(len(patch_frame))
+
+        for outbound in self.delta_listeners:
+            if outbound.has_pending(LEADERBOARD):
+                # leaderboard messages get coalesced, this patch would replace one the listener never got,
+                # the snapshot replaces it without breaking the chain
+                outbound.put_str(LEADERBOARD, self.snapshot_json)
+            else:
+                outbound.put(LEADERBOARD, patch_frame)
+
+    async def run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+
+            self.flush()
+
+            # everything that changes until then ends up in the next version
+            await asyncio.sleep(self.min_interval)
@@ -1,6 +1,37 @@
 from random import randint
 from typing import Optional
 
+import numpy as np
+
+
+def level_settings(level_id):
+    grid_size_x = 15 + 5 * (level_id-1)//2
+    # grid_size_x = 20 - (level_id - 1)*2
+    # grid_size_x = random.randint(1, 10)*5
+    max_effective_moves = 15 + 5 * (level_id-1)
+    # brightness = 1.0 - (level_id - 1) / levels_to_win
+    brightness = 1.0
+    return grid_size_x, max_effective_moves, brightness
+
+
+# 4 tiles per byte, 2 bits each, first tile in the lowest bits (same layout as the clients AnnounceProgress)
+def pack_tiles(tiles) -> bytes:
+    tiles = np.asarray(tiles, dtype=np.uint8).ravel()
+    padded = np.zeros(-(-len(tiles) // 4) * 4, dtype=np.uint8)
+    padded[:len(tiles)] = tiles
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)).tobytes()
+
+
+def unpack_tiles(data, tile_count) -> np.ndarray:
+    packed = np.frombuffer(data, dtype=np.uint8)
+    tiles = np.empty((len(packed), 4), dtype=np.uint8)
+    tiles[:, 0] = packed & 0b11
+    tiles[:, 1] = (packed >> 2) & 0b11
+    tiles[:, 2] = (packed >> 4) & 0b11
+    tiles[:, 3] = packed >> 6
+    return tiles.ravel()[:tile_count]
+
 
 class Generator:
     def __init__(self, grid_size_x, grid_size_y, max_effective_moves=10):
@@ -105,3 +136,97 @@ class Generator:
         self.tiles = [1 if x == 3 else x for x in self.tiles]
 
         return self.tiles, effective_moves
+
+
+# same random walk as Generator (identical output for the same random state),
+# but the grid is a 2-D uint8 array and every line is resolved with slicing and masks
+class NumpyGenerator:
+    def __init__(self, grid_size_x, grid_size_y, max_effective_moves=10):
+        self.grid_size_x = grid_size_x
+        self.grid_size_y = grid_size_y
+        self.max_effective_moves = max_effective_moves
+        self.tiles = np.ones((grid_size_y, grid_size_x), dtype=np.uint8)
+
+        self.x = 0
+        self.y = 3
+
+    def ray(self, dir_x, dir_y):
+        # view of all tiles from the next one in the given direction up to the border,
+        # the top 3 rows are out of bounds just like in Generator.in_bounds
+        if dir_x == 1:
+            return self.tiles[self.y, self.x + 1:]
+        if dir_x == -1:
+            return self.tiles[self.y, :self.x][::-1]
+        if dir_y == 1:
+            return self.tiles[self.y + 1:, self.x]
+        return self.tiles[3:self.y, self.x][::-1]
+
+    def generate_line(self, dir_x, dir_y, max_length):
+        ray = self.ray(dir_x, dir_y)
+        ray_length = len(ray)
+        if ray_length == 0:
+            return False
+
+        # walking stops in front of a blocker or the border
+        blocked = ray == 3
+        free_length = int(blocked.argmax())
+        if not blocked[free_length]:
+            free_length = ray_length
+
+        # walk at least max_length tiles, then keep going over already carved tiles
+        length = min(max_length, free_length)
+        if length < free_length:
+            solid = ray[length:free_length] != 0
+            extra = int(solid.argmax())
+            length += extra if solid[extra] else free_length - length
+
+        # there are no blockers in front of free_length, so any solid tile is a 1
+        was_effective = bool(ray[:length].any())
+        ray[:length] = 0
+
+        if length < ray_length:
+            ray[length] = 3
+
+        self.x += dir_x * length
+        self.y += dir_y * length
+
+        return was_effective
+
+    def generate(self):
+        RIGHT = 0
+        DOWN = 1
+        LEFT = 2
+        UP = 3
+
+        if self.y < self.grid_size_y:
+            self.tiles[self.y, self.x] = 0
+
+        effective_moves = 0
+
+        for i in range(1000):
+            d = round(randint(0, 3))
+
+            if (
+                    (d == LEFT and self.x == 0) or
+                    (d == RIGHT and self.x == self.grid_size_x - 1) or
+                    (d == UP and self.y == 0) or
+                    (d == DOWN and self.y == self.grid_size_y - 1)
+            ):
+                d = (d+2) % 4
+
+            m = round(randint(1, max(self.grid_size_x, self.grid_size_y)))
+            if d == RIGHT:
+                effective_moves += self.generate_line(1, 0, m)
+            elif d == DOWN:
+                effective_moves += self.generate_line(0, 1, m)
+            elif d == LEFT:
+                effective_moves += self.generate_line(-1, 0, m)
+            elif d == UP:
+                effective_moves += self.generate_line(0, -1, m)
+
+            if effective_moves == self.max_effective_moves:
+                break
+
+        self.tiles[self.tiles == 3] = 1
+
+        return self.tiles.ravel().tolist(), effective_moves
@@ -0,0 +1,186 @@
+import argparse
+import mmap
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import LevelGenerator
+from GenerationExecutor import generate_best_sample, reseed, SamplingStrategy
+from common import positive_int
+
+DATA_FILE_NAME = "levels.bin"
+INDEX_FILE_NAME = "levels.idx"
+
+FLAG_USED = 1
+
+# one fixed size record per stored level, the tiles live packed in the data file at data_offset
+INDEX_DTYPE = np.dtype([
+    ("grid_size_x", "<u2"),
+    ("grid_size_y", "<u2"),
+    ("max_effective_moves", "<u2"),
+    ("effective_moves", "<u2"),
+    ("flags", "u1"),
+    ("reserved", "V7"),
+    ("data_offset", "<u8"),
+])
+
+LevelKey = Tuple[int, int, int]
+
+
+def packed_size(grid_size_x, grid_size_y):
+    return -(-grid_size_x * grid_size_y // 4)
+
+
+class LevelLibrary:
+    # height_slack: if there is no level with the requested height, a level up to this many rows
+    # shorter is used instead, the client fills the missing rows with solid tiles
+    def __init__(self, path: str, height_slack=2):
+        self.path = path
+        self.height_slack = height_slack
+
+        os.makedirs(path, exist_ok=True)
+        self._data_file = open(os.path.join(path, DATA_FILE_NAME), "a+b")
+        self._index_file = open(os.path.join(path, INDEX_FILE_NAME), "a+b")
+
+        self._data_map: Optional[mmap.mmap] = None
+        self._index_map: Optional[mmap.mmap] = None
+        self._records: Optional[np.ndarray] = None
+        self._unused: Dict[LevelKey, List[int]] = {}
+        self._stale = True
+
+    def _unmap(self):
+        # the record array points into the index map, it has to go before the map can be closed
+        self._records = None
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._data_map is not None:
+            self._data_map.close()
+            self._data_map = None
+
+    def _map(self):
+        self._unmap()
+        self._data_file.flush()
+        self._index_file.flush()
+        self._unused = {}
+        self._stale = False
+
+        index_size = os.fstat(self._index_file.fileno()).st_size
+        index_size -= index_size % INDEX_DTYPE.itemsize
+        if index_size == 0:
+            return
+
+        self._index_map = mmap.mmap(self._index_file.fileno(), index_size)
+        self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._records = np.frombuffer(self._index_map, dtype=INDEX_DTYPE)
+
+        unused = np.flatnonzero((self._records["flags"] & FLAG_USED) == 0)
+        keys = zip(
+            self._records["grid_size_x"][unused].tolist(),
+            self._records["grid_size_y"][unused].tolist(),
+            self._records["max_effective_moves"][unused].tolist(),
+        )
+        for record_id, key in zip(unused.tolist(), keys):
+            self._unused.setdefault(key, []).append(record_id)
+
+    def _ensure_mapped(self):
+        if self._stale:
+            self._map()
+
+    def unused_count(self, grid_size_x, grid_size_y, max_effective_moves):
+        self._ensure_mapped()
+        return len(self._unused.get((grid_size_x, grid_size_y, max_effective_moves), ()))
+
+    def add(self, grid_size_x, grid_size_y, max_effective_moves, tiles, effective_moves):
+        data = LevelGenerator.pack_tiles(tiles)
+        assert len(data) == packed_size(grid_size_x, grid_size_y)
+
+        data_offset = self._data_file.seek(0, os.SEEK_END)
+        self._data_file.write(data)
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record["grid_size_x"] = grid_size_x
+        record["grid_size_y"] = grid_size_y
+        record["max_effective_moves"] = max_effective_moves
+        record["effective_moves"] = effective_moves
+        record["data_offset"] = data_offset
+        self._index_file.write(record.tobytes())
+
+        self._stale = True
+
+    def take(self, grid_size_x, grid_size_y, max_effective_moves, mark_used=False):
+        # returns a random stored (tiles, effective_moves) sample, just like a generator would, or None
+        self._ensure_mapped()
+
+        for height in range(grid_size_y, max(grid_size_y - self.height_slack, 1) - 1, -1):
+            candidates = self._unused.get((grid_size_x, height, max_effective_moves))
+            if candidates:
+                break
+        else:
+            return None
+
+        i = random.randrange(len(candidates))
+        record_id = candidates[i]
+        record = self._records[record_id]
+
+        if mark_used:
+            candidates[i] = candidates[-1]
+            candidates.pop()
+            self._records["flags"][record_id] |= FLAG_USED
+
+        data_offset = int(record["data_offset"])
+        data = self._data_map[data_offset:data_offset + packed_size(grid_size_x, height)]
+        tiles = LevelGenerator.unpack_tiles(data, grid_size_x * height)
+
+        return tiles.tolist(), int(record["effective_moves"])
+
+    def close(self):
+        self._unmap()
+        self._data_file.close()
+        self._index_file.close()
+
+
+def fill(library: LevelLibrary, level_count: int, min_ratio: float, max_ratio: float, count: int,
+         workers: Optional[int] = None, strategy=SamplingStrategy()):
+    jobs = []
+    for level_id in range(1, level_count + 1):
+        grid_size_x, max_effective_moves, _ = LevelGenerator.level_settings(level_id)
+        for grid_size_y in range(int(grid_size_x * min_ratio), int(grid_size_x * max_ratio) + 1):
+            missing = count - library.unused_count(grid_size_x, grid_size_y, max_effective_moves)
+            jobs += [(grid_size_x, grid_size_y, max_effective_moves)] * max(missing, 0)
+
+    print(f"generating {len(jobs)} levels")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=reseed) as executor:
+        futures = {
+            executor.submit(generate_best_sample, *job, strategy): job
+            for job in jobs
+        }
+        for i, future in enumerate(as_completed(futures)):
+            (tiles, effective_moves), _ = future.result()
+            library.add(*futures[future], tiles, effective_moves)
+
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1}/{len(jobs)}")
+
+    print("done")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pre-generate levels into a level library")
+    parser.add_argument("path")
+    parser.add_argument("--levels", type=int, default=8, help="generate levels 1..LEVELS")
+    parser.add_argument("--min-ratio", type=float, default=1.0, help="smallest level size ratio to cover")
+    parser.add_argument("--max-ratio", type=float, default=2.2, help="biggest level size ratio to cover")
+    parser.add_argument("--count", type=int, default=20, help="unused levels to keep per grid size")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--samples", type=positive_int, default=8, help="maximum samples generated per stored level")
+    args = parser.parse_args()
+
+    _library = LevelLibrary(args.path)
+    fill(_library, args.levels, args.min_ratio, args.max_ratio, args.count, args.workers,
+         SamplingStrategy(max_samples=args.samples))
+    _library.close()
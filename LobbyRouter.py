@@ -0,0 +1,92 @@
+import asyncio
+import zlib
+from typing import List
+
+import aiohttp
+from aiohttp import web, WSMessage
+from aiohttp.web_request import Request
+
+from GameManager import normalize_lobby_code
+
+# the router passes the address of the actual client along, lobby workers only trust it from loopback
+FORWARDED_FOR_HEADER = "X-Forwarded-For"
+
+# seconds the router waits for freshly started lobby workers to listen before it takes connections anyway
+WORKER_START_TIMEOUT = 30.0
+
+
+def worker_for_lobby(code: str, worker_count: int):
+    # stable across restarts, a lobby always ends up on the same worker
+    return zlib.crc32(code.encode()) % worker_count
+
+
+def client_remote(request: Request, trust_forwarded: bool):
+    if trust_forwarded and request.remote in ("127.0.0.1", "::1"):
+        return request.headers.get(FORWARDED_FOR_HEADER, request.remote)
+    return request.remote
+
+
+async def _pipe(source, target):
+    msg: WSMessage
+    async for msg in source:
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            await target.send_str(msg.data)
+        elif msg.type == aiohttp.WSMsgType.BINARY:
+            await target.send_bytes(msg.data)
+        else:
+            break
+
+
+class LobbyRouter:
+    # only looks at the lobby code of a websocket and passes its frames on to the worker process that owns it,
+    # all the game logic runs in the workers
+    def __init__(self, worker_ports: List[int]):
+        self.worker_ports = worker_ports
+        self.client_session: aiohttp.ClientSession | None = None
+
+    async def wait_for_workers(self, timeout=WORKER_START_TIMEOUT):
+        # the workers are separate processes that need a moment to import everything and start listening,
+        # until they do every client would get a 502
+        deadline = asyncio.get_running_loop().time() + timeout
+        for port in self.worker_ports:
+            while True:
+                try:
+                    _, writer = await asyncio.open_connection("127.0.0.1", port)
+                except OSError:
+                    if asyncio.get_running_loop().time() > deadline:
+                        print(f"lobby worker on port {port} isn't listening, its lobbies will fail")
+                        break
+                    await asyncio.sleep(0.1)
+                    continue
+
+                writer.close()
+                await writer.wait_closed()
+                break
+
+    async def websocket_handler(self, request: Request):
+        # invalid codes are passed on as well, the worker tells the client what's wrong
+        code = normalize_lobby_code(request.query.get("lobby", ""))
+        port = self.worker_ports[worker_for_lobby(code or "", len(self.worker_ports))]
+
+        if self.client_session is None:
+            self.client_session = aiohttp.ClientSession()
+
+        try:
+            upstream = await self.client_session.ws_connect(
+                f"http://127.0.0.1:{port}{request.path_qs}",
+                headers={FORWARDED_FOR_HEADER: request.remote or ""}
+            )
+        except aiohttp.ClientError:
+            return web.Response(status=502)
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        pipes = [asyncio.ensure_future(_pipe(ws, upstream)), asyncio.ensure_future(_pipe(upstream, ws))]
+        await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+        for pipe in pipes:
+            pipe.cancel()
+
+        await upstream.close()
+        await ws.close()
+        return ws
@@ -0,0 +1,37 @@
+from typing import Iterable, NamedTuple, Tuple
+
+
+def create_level_message(level_id, level_name: str, grid_size_x: int, brightness: float, level_str: str):
+    return f"level:{level_id};{level_name};{grid_size_x};{brightness};{level_str}"
+
+
+def create_packed_level_message(level_id, level_name: str, grid_size_x: int, brightness: float, tile_count: int,
+                                packed_level_str: str):
+    return f"level_packed:{level_id};{level_name};{grid_size_x};{brightness};{tile_count};{packed_level_str}"
+
+
+def create_lobby_message(players: Iterable[Tuple[str, bool]]):
+    players_str = "\n".join(name+("+" if ready else "-") for name, ready in players)
+    return f"lobby:{players_str}"
+
+
+def create_message(message, bg_style="#000", fg_style="#fff"):
+    return f"message:{bg_style};{fg_style};{message}"
+
+
+def create_overlay_message(message, style="#fff", display_time=1.0, animation="none"):
+    return f"overlay_message:{display_time};{animation};{style};{message}"
+
+
+class ResultMessage(NamedTuple):
+    message: str
+    bg_style: str
+    fg_style: str
+
+    def to_message(self, players_left):
+        message = self.message
+        if players_left > 0:
+            message += f"\n{players_left} players left"
+        else:
+            message += "\nGame complete"
+        return create_message(message, self.bg_style, self.fg_style)
@@ -0,0 +1,156 @@
+import bisect
+import math
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# everything is only ever touched from the event loop thread, so there are no locks,
+# a histogram observation is one bisect over its bounds and two additions into lists that exist from the start
+
+# seconds, from a quick command to a level that took way too long to generate
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# label values -> value, for metrics that are read from somewhere else when they're scraped
+Samples = Iterable[Tuple[Tuple[str, ...], float]]
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Sequence[float]):
+        self.upper_bounds = upper_bounds
+        # one count per bucket and the last one for everything above, made cumulative when rendered
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+def format_value(value: float):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def escape_label_value(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class Family:
+    # all children of one metric name, one per combination of label values
+    def __init__(self, name: str, help_text: str, kind: str, label_names: Sequence[str], create: Callable):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self._create = create
+        self.children: Dict[Tuple[str, ...], object] = {}
+        if not self.label_names:
+            self.labels()
+
+    def labels(self, *values: str):
+        # look the child up once and keep it, this is the only place that allocates
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} has the labels {self.label_names}, got {values}")
+            child = self.children[values] = self._create()
+        return child
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in self.children.items():
+            labels = format_labels(self.label_names, values)
+            if isinstance(child, Counter):
+                lines.append(f"{self.name}{labels} {format_value(child.value)}")
+                continue
+
+            total = 0
+            for upper_bound, count in zip(child.upper_bounds + (math.inf,), child.counts):
+                total += count
+                bucket_labels = format_labels(self.label_names + ("le",), values + (format_value(upper_bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+            lines.append(f"{self.name}_sum{labels} {format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {total}")
+
+
+class FunctionFamily:
+    # a counter or gauge whose values are collected from existing state at scrape time, free on the hot path
+    def __init__(self, name: str, help_text: str, kind: str, label_names: Sequence[str],
+                 collect: Callable[[], float | Samples]):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def render(self, lines: List[str]):
+        samples = self.collect()
+        if not self.label_names:
+            samples = [((), samples)]
+
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, value in samples:
+            lines.append(f"{self.name}{format_labels(self.label_names, values)} {format_value(value)}")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.families: Dict[str, Family | FunctionFamily] = {}
+
+    def _add(self, family):
+        if family.name in self.families:
+            raise ValueError(f"metric {family.name} is already registered")
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Family:
+        return self._add(Family(name, help_text, "counter", label_names, Counter))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Family:
+        buckets = tuple(sorted(buckets))
+        return self._add(Family(name, help_text, "histogram", label_names, lambda: Histogram(buckets)))
+
+    def counter_function(self, name: str, help_text: str, collect: Callable[[], float | Samples],
+                         label_names: Sequence[str] = ()):
+        return self._add(FunctionFamily(name, help_text, "counter", label_names, collect))
+
+    def gauge_function(self, name: str, help_text: str, collect: Callable[[], float | Samples],
+                       label_names: Sequence[str] = ()):
+        return self._add(FunctionFamily(name, help_text, "gauge", label_names, collect))
+
+    def render(self):
+        lines: List[str] = []
+        for family in self.families.values():
+            family.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,220 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from aiohttp import WSMsgType
+from aiohttp.web_ws import WebSocketResponse
+
+from Metrics import metrics
+
+# a client that can't take a frame within this time is considered dead and gets disconnected
+SEND_TIMEOUT = 2.0
+
+# pending messages per connection before the drop policies kick in
+MAX_QUEUE_SIZE = 32
+
+
+class Delivery(Enum):
+    # always delivered, even if that means going over MAX_QUEUE_SIZE
+    RELIABLE = 0
+    # only the newest pending message of this class matters, it replaces older ones in place,
+    # never dropped, with at most one pending per class it can only go over MAX_QUEUE_SIZE by that much
+    LATEST = 1
+    # nice to have, dropped if the queue is full
+    DROPPABLE = 2
+
+
+class MessageClass(NamedTuple):
+    name: str
+    delivery: Delivery
+
+
+LEVEL = MessageClass("level", Delivery.RELIABLE)
+RESULT = MessageClass("result", Delivery.RELIABLE)
+MESSAGE = MessageClass("message", Delivery.RELIABLE)
+LOBBY = MessageClass("lobby", Delivery.LATEST)
+LEADERBOARD = MessageClass("leaderboard", Delivery.LATEST)
+OVERLAY = MessageClass("overlay", Delivery.DROPPABLE)
+
+
+class OutboundStats:
+    def __init__(self):
+        self.sent: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+        self.bytes_sent: Dict[str, int] = {}
+        self.disconnected = 0
+
+
+stats = OutboundStats()
+
+
+def _count(counter: Dict[str, int], message_class: MessageClass):
+    counter[message_class.name] = counter.get(message_class.name, 0) + 1
+
+
+_queues: "weakref.WeakSet[OutboundQueue]" = weakref.WeakSet()
+
+
+def queue_depths() -> List[int]:
+    return [len(queue) for queue in _queues]
+
+
+def _outcomes():
+    for outcome, counter in (("sent", stats.sent), ("dropped", stats.dropped), ("coalesced", stats.coalesced)):
+        for name, count in counter.items():
+            yield (name, outcome), count
+
+
+metrics.counter_function("colorfill_outbound_messages_total", "outbound websocket messages by what happened to them",
+                         _outcomes, ("message_class", "outcome"))
+metrics.counter_function("colorfill_outbound_bytes_total", "bytes sent on websockets",
+                         lambda: (((name,), count) for name, count in stats.bytes_sent.items()), ("message_class",))
+metrics.counter_function("colorfill_outbound_disconnects_total",
+                         "connections dropped because a send failed or timed out", lambda: stats.disconnected)
+metrics.gauge_function("colorfill_outbound_queued_messages", "messages waiting in outbound queues",
+                       lambda: sum(queue_depths()))
+
+
+async def send_frame(ws: WebSocketResponse, frame: bytes, timeout=SEND_TIMEOUT):
+    try:
+        await asyncio.wait_for(ws.send_frame(frame, WSMsgType.TEXT), timeout)
+        return True
+    except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+        # don't wait for the closing handshake, the socket is either gone or too slow for that anyway
+        asyncio.ensure_future(ws.close())
+        return False
+
+
+class _Entry:
+    __slots__ = ("message_class", "frame")
+
+    def __init__(self, message_class: MessageClass, frame: bytes):
+        self.message_class = message_class
+        self.frame = frame
+
+
+class OutboundQueue:
+    # every connection gets one of these, a dedicated writer task drains it,
+    # so nobody ever has to wait for a slow client
+    __slots__ = ("ws", "max_size", "send_timeout", "_entries", "_latest", "_wakeup", "_writer", "__weakref__")
+
+    def __init__(self, ws: WebSocketResponse, max_size=MAX_QUEUE_SIZE, send_timeout=SEND_TIMEOUT):
+        self.ws = ws
+        self.max_size = max_size
+        self.send_timeout = send_timeout
+
+        self._entries: Deque[_Entry] = deque()
+        self._latest: Dict[MessageClass, _Entry] = {}
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    def has_pending(self, message_class: MessageClass):
+        # only known for classes that get coalesced
+        return message_class in self._latest
+
+    def put_str(self, message_class: MessageClass, message: str):
+        self.put(message_class, message.encode("utf-8"))
+
+    def put(self, message_class: MessageClass, frame: bytes):
+        if self.ws.closed:
+            return
+
+        if message_class.delivery == Delivery.LATEST:
+            pending = self._latest.get(message_class)
+            if pending is not None:
+                pending.frame = frame
+                _count(stats.coalesced, message_class)
+                return
+
+        if len(self._entries) >= self.max_size and not self._make_room(message_class):
+            _count(stats.dropped, message_class)
+            return
+
+        entry = _Entry(message_class, frame)
+        self._entries.append(entry)
+        if message_class.delivery == Delivery.LATEST:
+            self._latest[message_class] = entry
+
+        self._wakeup.set()
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write())
+
+    def _make_room(self, message_class: MessageClass):
+        # evicts the oldest droppable message, reliable and latest ones are only ever queued on top
+        for entry in self._entries:
+            if entry.message_class.delivery == Delivery.DROPPABLE:
+                self._entries.remove(entry)
+                _count(stats.dropped, entry.message_class)
+                return True
+
+        return message_class.delivery != Delivery.DROPPABLE
+
+    async def _write(self):
+        while not self.ws.closed:
+            if not self._entries:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            entry = self._entries.popleft()
+            if self._latest.get(entry.message_class) is entry:
+                del self._latest[entry.message_class]
+
+            if not await send_frame(self.ws, entry.frame, self.send_timeout):
+                stats.disconnected += 1
+                break
+
+            _count(stats.sent, entry.message_class)
+            name = entry.message_class.name
+            stats.bytes_sent[name] = stats.bytes_sent.get(name, 0) + len(entry.frame)
+
+        self._entries.clear()
+        self._latest.clear()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._entries.clear()
+        self._latest.clear()
+
+
+class DetachedOutbound:
+    # stands in for the socket of a player restored from the journal until the client reconnects,
+    # messages go nowhere, after the timeout it counts as closed and the player gets removed like any other
+    __slots__ = ("deadline",)
+
+    def __init__(self, timeout: float):
+        self.deadline = time.monotonic() + timeout
+
+    def __len__(self):
+        return 0
+
+    @property
+    def closed(self):
+        return time.monotonic() >= self.deadline
+
+    def has_pending(self, _message_class: MessageClass):
+        return False
+
+    def put_str(self, message_class: MessageClass, message: str):
+        pass
+
+    def put(self, message_class: MessageClass, frame: bytes):
+        pass
+
+    def close(self):
+        self.deadline = 0.0
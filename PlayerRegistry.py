@@ -0,0 +1,186 @@
+from bisect import bisect_left, insort
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+
+class TrackedPlayer:
+    # base for player records, reports every change of the fields the registry keeps indexes for
+    __slots__ = ("id", "slot", "_registry", "_is_ready", "_result_message", "_level", "_level_progress")
+
+    def __init__(self, player_id: int):
+        self.id = player_id
+        # where the player is in its registry, -1 while it isn't in one
+        self.slot = -1
+        self._registry: Optional["PlayerRegistry"] = None
+        self._is_ready = False
+        self._result_message = None
+        self._level = 0
+        self._level_progress = 0.0
+
+    @property
+    def registered(self):
+        return self._registry is not None
+
+    def _rank_key(self) -> Tuple[float, int]:
+        # best player first, players with the same score stay in the order they joined
+        return -(self._level + self._level_progress), self.id
+
+    @property
+    def is_ready(self) -> bool:
+        return self._is_ready
+
+    @is_ready.setter
+    def is_ready(self, value: bool):
+        if self._registry is not None and value != self._is_ready:
+            self._registry.ready_count += 1 if value else -1
+        self._is_ready = value
+
+    @property
+    def result_message(self):
+        return self._result_message
+
+    @result_message.setter
+    def result_message(self, value):
+        if self._registry is not None and (value is None) != (self._result_message is None):
+            self._registry.done_count += 1 if value is not None else -1
+        self._result_message = value
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    @level.setter
+    def level(self, value: int):
+        if self._registry is not None:
+            self._registry._unrank(self)
+        self._level = value
+        if self._registry is not None:
+            self._registry._rank(self)
+
+    @property
+    def level_progress(self) -> float:
+        return self._level_progress
+
+    @level_progress.setter
+    def level_progress(self, value: float):
+        if self._registry is not None:
+            self._registry._unrank(self)
+        self._level_progress = value
+        if self._registry is not None:
+            self._registry._rank(self)
+
+
+P = TypeVar("P", bound=TrackedPlayer)
+
+
+class PlayerRegistry(Generic[P]):
+    # a table of players that keeps the ready/done counts and the ranking up to date while the players change,
+    # the ranking is a sorted list, so finding a player in it is a binary search
+    #
+    # players are stored in slots, a slot is reused once its player is gone,
+    # so a slot number alone doesn't identify a player for long, the session tokens take care of that
+    def __init__(self):
+        self._slots: List[Optional[P]] = []
+        self._free_slots: List[int] = []
+        self._count = 0
+        self._by_id: Dict[int, P] = {}
+        self._ranking: List[Tuple[float, int]] = []
+        self.ready_count = 0
+        self.done_count = 0
+
+    def _rank(self, player: P):
+        insort(self._ranking, player._rank_key())
+
+    def _unrank(self, player: P):
+        key = player._rank_key()
+        i = bisect_left(self._ranking, key)
+        del self._ranking[i]
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, slot: int):
+        return self.get(slot) is not None
+
+    def __getitem__(self, slot: int) -> P:
+        player = self.get(slot)
+        if player is None:
+            raise KeyError(slot)
+        return player
+
+    def __delitem__(self, slot: int):
+        player = self[slot]
+        self._slots[slot] = None
+        self._free_slots.append(slot)
+        self._count -= 1
+
+        self._unrank(player)
+        del self._by_id[player.id]
+        self.ready_count -= player.is_ready
+        self.done_count -= player.result_message is not None
+        player._registry = None
+        player.slot = -1
+
+    def add(self, player: P, slot: Optional[int] = None) -> int:
+        # a slot is only asked for when players get restored, their session tokens name the slot
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                slot = len(self._slots)
+                self._slots.append(None)
+        else:
+            if self.get(slot) is not None:
+                raise ValueError(f"slot {slot} is taken")
+            while len(self._slots) <= slot:
+                self._free_slots.append(len(self._slots))
+                self._slots.append(None)
+            self._free_slots.remove(slot)
+
+        self._slots[slot] = player
+        self._count += 1
+
+        player._registry = self
+        player.slot = slot
+        self._by_id[player.id] = player
+        self._rank(player)
+        self.ready_count += player.is_ready
+        self.done_count += player.result_message is not None
+        return slot
+
+    def remove(self, player: P):
+        if player._registry is self:
+            del self[player.slot]
+
+    def get(self, slot: int, default: Optional[P] = None) -> Optional[P]:
+        if 0 <= slot < len(self._slots):
+            player = self._slots[slot]
+            if player is not None:
+                return player
+        return default
+
+    def keys(self) -> Iterator[int]:
+        return (slot for slot, player in enumerate(self._slots) if player is not None)
+
+    def values(self) -> Iterator[P]:
+        return (player for player in self._slots if player is not None)
+
+    def items(self) -> Iterator[Tuple[int, P]]:
+        return ((slot, player) for slot, player in enumerate(self._slots) if player is not None)
+
+    def clear(self):
+        for player in self.values():
+            player._registry = None
+            player.slot = -1
+        self._slots.clear()
+        self._free_slots.clear()
+        self._count = 0
+        self._by_id.clear()
+        self._ranking.clear()
+        self.ready_count = 0
+        self.done_count = 0
+
+    def ranked(self) -> Iterator[P]:
+        return (self._by_id[player_id] for _, player_id in self._ranking)
+
+    def rank_of(self, player: P) -> int:
+        return bisect_left(self._ranking, player._rank_key()) + 1
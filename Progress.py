@@ -0,0 +1,200 @@
+import base64
+import random
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# tiles are packed 4 per byte, 2 bits each, see LevelGenerator.pack_tiles
+EMPTY = 0
+FILLED = 2
+
+# boards are way smaller than this, anything bigger is a broken or malicious client
+MAX_GRID_SIZE = 1024
+
+# share of AnnounceProgress messages with client side counts that get checked against the board anyway
+VERIFY_RATE = 1 / 8
+
+
+def _build_tile_count_table():
+    values = np.arange(256, dtype=np.uint8)
+    tiles = np.stack([(values >> (2 * i)) & 0b11 for i in range(4)], axis=1)
+    return np.stack([
+        np.count_nonzero(tiles == EMPTY, axis=1),
+        np.count_nonzero(tiles == FILLED, axis=1),
+    ], axis=1).astype(np.int64)
+
+
+# (empty, filled) tile counts for every possible packed byte
+TILE_COUNTS = _build_tile_count_table()
+
+
+def count_tiles(packed: bytes, tile_count: int):
+    # a histogram of the byte values weighted by the table, nothing in here scales with the board except bincount
+    histogram = np.bincount(np.frombuffer(packed, dtype=np.uint8), minlength=256)
+    empty_count, filled_count = (histogram @ TILE_COUNTS).tolist()
+
+    # the client pads the last byte with empty tiles
+    padding = len(packed) * 4 - tile_count
+    if 0 < padding < 4:
+        empty_count -= padding
+
+    return empty_count, filled_count
+
+
+class ProgressReport(NamedTuple):
+    grid_size_x: int
+    grid_size_y: int
+    # "grid_size_x;grid_size_y;base64 board", what the leaderboard gets to see
+    board_message: str
+    packed: bytes
+    empty_count: int
+    filled_count: int
+    # None if the client didn't send counts or they weren't checked
+    counts_verified: Optional[bool]
+
+    @property
+    def progress(self):
+        total = self.empty_count + self.filled_count
+        return self.filled_count / total if total > 0 else 0.0
+
+
+def is_number(text: str):
+    # str.isdigit alone also takes characters like "²", which int() can't parse
+    return text.isascii() and text.isdigit()
+
+
+def should_verify(trusted: bool):
+    return not trusted or random.random() < VERIFY_RATE
+
+
+def parse_progress(data: str, verify=True) -> Optional[ProgressReport]:
+    # "grid_size_x;grid_size_y;base64 board", optionally followed by ";empty_count;filled_count"
+    parts = data.split(";")
+    if len(parts) not in (3, 5) or not is_number(parts[0]) or not is_number(parts[1]):
+        return None
+
+    grid_size_x = int(parts[0])
+    grid_size_y = int(parts[1])
+    if not 0 < grid_size_x <= MAX_GRID_SIZE or not 0 < grid_size_y <= MAX_GRID_SIZE:
+        return None
+
+    board_message = data if len(parts) == 3 else ";".join(parts[:3])
+    packed = base64.b64decode(parts[2])
+
+    if len(parts) == 5:
+        if not is_number(parts[3]) or not is_number(parts[4]):
+            return None
+
+        claimed = int(parts[3]), int(parts[4])
+        if not verify and sum(claimed) <= grid_size_x * grid_size_y:
+            return ProgressReport(grid_size_x, grid_size_y, board_message, packed, *claimed, None)
+
+    empty_count, filled_count = count_tiles(packed, grid_size_x * grid_size_y)
+    # padding tiles that aren't empty, or more tiles than the board has
+    if empty_count < 0 or empty_count + filled_count > grid_size_x * grid_size_y:
+        return None
+
+    counts_verified = None
+    if len(parts) == 5:
+        counts_verified = claimed == (empty_count, filled_count)
+
+    return ProgressReport(grid_size_x, grid_size_y, board_message, packed, empty_count, filled_count,
+                          counts_verified)
+
+
+class ProgressBoard:
+    # the last board a player reported, kept packed, so deltas can be applied in place
+    #
+    # a full board (AnnounceProgress) resets the version to 0, every delta that gets applied increments it
+    # "AnnounceProgressDelta:base_version;offset,base64 bytes;offset,base64 bytes;..."
+    # with the ranges in ascending order and not overlapping, anything else is rejected like a bad range
+    # a delta for a version the server doesn't have is rejected, the client gets one "progress_resync:"
+    # and has to send a full board next
+    __slots__ = ("grid_size_x", "grid_size_y", "tiles", "version", "empty_count", "filled_count", "resync_requested",
+                 "_message")
+
+    def __init__(self):
+        self.grid_size_x = 0
+        self.grid_size_y = 0
+        self.tiles: Optional[bytearray] = None
+        self.version = 0
+        self.empty_count = 0
+        self.filled_count = 0
+        self.resync_requested = False
+        self._message = ""
+
+    @property
+    def progress(self):
+        total = self.empty_count + self.filled_count
+        return self.filled_count / total if total > 0 else 0.0
+
+    @property
+    def message(self):
+        # only built when the leaderboard asks for it, not on every delta
+        if self._message is None:
+            self._message = f"{self.grid_size_x};{self.grid_size_y};{base64.b64encode(self.tiles).decode()}"
+        return self._message
+
+    def load(self, report: ProgressReport):
+        self.grid_size_x = report.grid_size_x
+        self.grid_size_y = report.grid_size_y
+        self.tiles = bytearray(report.packed)
+        self.version = 0
+        self.empty_count = report.empty_count
+        self.filled_count = report.filled_count
+        self.resync_requested = False
+        self._message = report.board_message
+
+    def patch(self, data: str):
+        # applies all ranges of a delta or none of them
+        if self.tiles is None or self.resync_requested:
+            return False
+
+        parts = data.split(";")
+        if not is_number(parts[0]) or int(parts[0]) != self.version:
+            return False
+
+        ranges = []
+        previous_end = 0
+        for part in parts[1:]:
+            if not part:
+                continue
+
+            offset, _, encoded = part.partition(",")
+            if not is_number(offset):
+                return False
+
+            offset = int(offset)
+            try:
+                new_bytes = base64.b64decode(encoded, validate=True)
+            except ValueError:
+                return False
+            # ranges have to be ascending and can't overlap, the counts below assume every byte is replaced once
+            if offset < previous_end or offset + len(new_bytes) > len(self.tiles):
+                return False
+
+            previous_end = offset + len(new_bytes)
+            ranges.append((offset, new_bytes))
+
+        # all ranges are counted together, a count costs about the same for one byte as for a whole board
+        # padding tiles are empty before and after, so they cancel out here
+        tiles = memoryview(self.tiles)
+        replaced = b"".join(tiles[offset:offset + len(new_bytes)] for offset, new_bytes in ranges)
+        replacements = b"".join(new_bytes for _, new_bytes in ranges)
+        old_empty, old_filled = count_tiles(replaced, len(replaced) * 4)
+        new_empty, new_filled = count_tiles(replacements, len(replacements) * 4)
+        empty_count = self.empty_count + new_empty - old_empty
+        filled_count = self.filled_count + new_filled - old_filled
+        # only possible by filling the padding tiles of the last byte
+        if empty_count < 0:
+            return False
+
+        for offset, new_bytes in ranges:
+            tiles[offset:offset + len(new_bytes)] = new_bytes
+
+        self.empty_count = empty_count
+        self.filled_count = filled_count
+
+        self.version += 1
+        self._message = None
+        return True
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Callable, Optional, Set
+
+
+class ScheduledEvent:
+    __slots__ = ("deadline", "callback", "_scheduler", "_handle")
+
+    def __init__(self, scheduler: "Scheduler", deadline: float, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.callback = callback
+        self._scheduler = scheduler
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def cancelled(self):
+        return self._handle is None
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._scheduler._events.discard(self)
+
+    def _fire(self):
+        self._handle = None
+        self._scheduler._events.discard(self)
+        self.callback()
+
+
+class Scheduler:
+    # timed events of one game, deadlines are absolute times of the loops monotonic clock,
+    # so an event that runs late doesn't push back the ones after it
+    # events are plain loop timers, no task per event, and cancel_all gets rid of all of them at once
+    def __init__(self):
+        self._events: Set[ScheduledEvent] = set()
+
+    def __len__(self):
+        return len(self._events)
+
+    @staticmethod
+    def now():
+        return asyncio.get_event_loop().time()
+
+    def at(self, deadline: float, callback: Callable[[], None]) -> ScheduledEvent:
+        event = ScheduledEvent(self, deadline, callback)
+        event._handle = asyncio.get_event_loop().call_at(deadline, event._fire)
+        self._events.add(event)
+        return event
+
+    def after(self, delay: float, callback: Callable[[], None]) -> ScheduledEvent:
+        return self.at(self.now() + delay, callback)
+
+    def cancel_all(self):
+        for event in list(self._events):
+            event.cancel()
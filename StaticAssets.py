@@ -0,0 +1,166 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional
+
+from aiohttp import web
+from aiohttp.web_request import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bigger files aren't kept in memory, they're sent straight from disk with sendfile
+LARGE_FILE_SIZE = 1 << 20
+
+# smaller files aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "font/ttf",
+                      "font/otf")
+
+# these change with every build and have no version in their name, clients always revalidate them (cheap with etags)
+REVALIDATED_EXTENSIONS = (".html", ".js", ".css", ".map")
+MAX_AGE = 24 * 60 * 60
+
+
+class Asset(NamedTuple):
+    path: str
+    content_type: str
+    etag: str
+    cache_control: str
+    mtime_ns: int
+    size: int
+    # None for large files
+    body: Optional[bytes]
+    gzip_body: Optional[bytes]
+    brotli_body: Optional[bytes]
+
+
+def load_asset(path: str) -> Asset:
+    stat = os.stat(path)
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if path.endswith(REVALIDATED_EXTENSIONS):
+        cache_control = "no-cache"
+    else:
+        cache_control = f"public, max-age={MAX_AGE}"
+
+    if stat.st_size >= LARGE_FILE_SIZE:
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        return Asset(path, content_type, etag, cache_control, stat.st_mtime_ns, stat.st_size, None, None, None)
+
+    with open(path, "rb") as file:
+        body = file.read()
+
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+    gzip_body = None
+    brotli_body = None
+    if len(body) >= MIN_COMPRESS_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+        gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(gzip_body) >= len(body):
+            gzip_body = None
+        if brotli is not None:
+            brotli_body = brotli.compress(body)
+            if len(brotli_body) >= len(body):
+                brotli_body = None
+
+    return Asset(path, content_type, etag, cache_control, stat.st_mtime_ns, stat.st_size, body, gzip_body,
+                 brotli_body)
+
+
+def etag_matches(if_none_match: str, etag: str):
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+Manifest = Mapping[str, Asset]
+
+
+class StaticAssets:
+    # every file of every app is read, compressed and hashed once, requests are answered from memory,
+    # a path that isn't in the manifest of its app is a 404 without ever looking at the disk
+    def __init__(self, apps: Dict[str, str]):
+        # app name -> directory
+        self.apps = dict(apps)
+        self.manifests: Mapping[str, Manifest] = MappingProxyType({})
+
+    @staticmethod
+    def _walk(root: str):
+        # (url path relative to the app, path on disk)
+        for directory, _, file_names in os.walk(root):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+    def load(self):
+        self.manifests = MappingProxyType({
+            app: MappingProxyType({url_path: load_asset(path) for url_path, path in self._walk(root)})
+            for app, root in self.apps.items()
+        })
+        print(f"loaded {sum(len(x) for x in self.manifests.values())} static assets")
+
+    def reload_changed(self):
+        # builds new manifests, requests keep using the old ones until they're swapped in
+        manifests = {}
+        changed = 0
+        for app, root in self.apps.items():
+            old_manifest = self.manifests.get(app, {})
+            manifest = {}
+            for url_path, path in self._walk(root):
+                asset = old_manifest.get(url_path)
+                try:
+                    stat = os.stat(path)
+                    if asset is None or asset.mtime_ns != stat.st_mtime_ns or asset.size != stat.st_size:
+                        asset = load_asset(path)
+                        changed += 1
+                except OSError:
+                    # deleted while we were looking
+                    continue
+                manifest[url_path] = asset
+
+            changed += len(old_manifest.keys() - manifest.keys())
+            manifests[app] = MappingProxyType(manifest)
+
+        if changed:
+            self.manifests = MappingProxyType(manifests)
+            print(f"reloaded {changed} static assets")
+
+    async def watch(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.reload_changed)
+
+    def get(self, app: str, path: str) -> Optional[Asset]:
+        manifest = self.manifests.get(app)
+        return manifest.get(path) if manifest is not None else None
+
+    def response(self, request: Request, asset: Asset) -> web.StreamResponse:
+        headers = {"ETag": asset.etag, "Cache-Control": asset.cache_control}
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None and etag_matches(if_none_match, asset.etag):
+            return web.Response(status=304, headers=headers)
+
+        if asset.body is None:
+            return web.FileResponse(asset.path, headers={"Cache-Control": asset.cache_control})
+
+        body = asset.body
+        accept_encoding = request.headers.get("Accept-Encoding", "")
+        if asset.gzip_body is not None or asset.brotli_body is not None:
+            headers["Vary"] = "Accept-Encoding"
+            if asset.brotli_body is not None and "br" in accept_encoding:
+                body = asset.brotli_body
+                headers["Content-Encoding"] = "br"
+            elif asset.gzip_body is not None and "gzip" in accept_encoding:
+                body = asset.gzip_body
+                headers["Content-Encoding"] = "gzip"
+
+        return web.Response(body=body, content_type=asset.content_type, headers=headers)
+
+
+static_assets = StaticAssets({"client": "ColorFill-Client/public", "leaderboard": "Live-Leaderboard/public"})
@@ -1,11 +1,12 @@
+import argparse
 import json
-import re
 from typing import Callable, NamedTuple, Union, List, Protocol
 
-import aiohttp
 from aiohttp import WSMessage
 from aiohttp.web_ws import WebSocketResponse
 
+from Commands import CommandDispatcher, message_text
+
 
 class Lobby(NamedTuple):
     class Player(NamedTuple):
@@ -86,44 +87,17 @@ class SocketWrapper:
         self.on_announce_progress_received: Callable[[LevelProgress], None] | None = None
         self.on_announce_done_received: Callable[[], None] | None = None
 
+    async def run(self):
         msg: WSMessage
-        async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                continue
-            if msg.data == 'close':
-                await ws.close()
+        async for msg in self.ws:
+            message = message_text(msg)
+            if message is None:
                 continue
-
-            match = re.match(r"^([a-zA-Z0-9_]*)(?::([\s\S]*))?$", msg.data)
-            if not match:
+            if message == 'close':
+                await self.ws.close()
                 continue
 
-            command, data = match.groups()
-
-            if command == "RegisterPlayer":
-                player_info = json.loads(data)
-
-                if self.on_register_player_received:
-                    name: str = player_info["name"]
-                    self.on_register_player_received(
-                        PlayerInfo(name.replace("\n", ""), player_info["levelSizeRatio"])
-                    )
-
-            elif command == "ChangeName":
-                if self.on_change_name_received:
-                    self.on_change_name_received(data.replace("\n", ""))
-            elif command == "AnnounceReady":
-                if self.on_announce_ready_received:
-                    self.on_announce_ready_received()
-            elif command == "AnnounceProgress":
-                if self.on_announce_ready_received:
-                    width, height, string = re.match(r"^([0-9]+);;([0-9]+);([-A-Za-z0-9+/=]*)$", data)
-                    self.on_announce_progress_received(
-                        LevelProgress(int(width), int(height), string)
-                    )
-            elif command == "AnnounceDone":
-                if self.on_announce_done_received:
-                    self.on_announce_done_received()
+            await socket_commands.dispatch(self, message)
 
     def send_lobby(self, lobby: Lobby):
         players_str = "\n".join(name + ("+" if ready else "-") for name, ready in lobby.players)
@@ -148,3 +122,60 @@ class SocketWrapper:
         elif isinstance(message, OverlayText):
             self.send_overlay_text(message)
 
+
+socket_commands = CommandDispatcher()
+
+
+@socket_commands.command("RegisterPlayer")
+def _register_player(socket: SocketWrapper, data: str):
+    if socket.on_register_player_received:
+        player_info = json.loads(data)
+        name: str = player_info["name"]
+        socket.on_register_player_received(
+            PlayerInfo(name.replace("\n", ""), player_info["levelSizeRatio"])
+        )
+
+
+@socket_commands.command("ChangeName")
+def _change_name(socket: SocketWrapper, data: str):
+    if socket.on_change_name_received:
+        socket.on_change_name_received(data.replace("\n", ""))
+
+
+@socket_commands.command("AnnounceReady")
+def _announce_ready(socket: SocketWrapper, _data: str):
+    if socket.on_announce_ready_received:
+        socket.on_announce_ready_received()
+
+
+@socket_commands.command("AnnounceProgress")
+def _announce_progress(socket: SocketWrapper, data: str):
+    if socket.on_announce_progress_received:
+        # "width;height;base64 board", anything after that (like client side counts) is ignored here
+        parts = data.split(";")
+        if len(parts) >= 3 and all(x.isascii() and x.isdigit() for x in parts[:2]):
+            socket.on_announce_progress_received(
+                LevelProgress(int(parts[0]), int(parts[1]), parts[2])
+            )
+
+
+@socket_commands.command("AnnounceDone")
+def _announce_done(socket: SocketWrapper, _data: str):
+    if socket.on_announce_done_received:
+        socket.on_announce_done_received()
+
+
+# argparse types for the command line options of main.py and LevelLibrary.py
+
+def positive_int(value: str):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"has to be at least 1, got {number}")
+    return number
+
+
+def positive_float(value: str):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"has to be more than 0, got {number}")
+    return number
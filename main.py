@@ -1,467 +1,427 @@
-import base64
-import json
-import mimetypes
-import os.path
-import re
-import sys
-from typing import Optional, Callable, NamedTuple, Tuple, Iterable
+import argparse
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import time
+
+from typing import Callable, Optional
 
 import aiohttp
 from aiohttp import web, WSMessage
 import asyncio
 
 from aiohttp.web_request import Request
-from aiohttp.web_ws import WebSocketResponse
-
-import LevelGenerator
-import numpy as np
-
-generated_levels: list[str] = []
-generated_levels_lock = asyncio.Lock()
-
-levels_to_win = 8
-
-remote_player_infos = {}
-
-
-async def get_level(level_id):
-    grid_size_x = 15 + 5 * (level_id-1)//2
-    # grid_size_x = 20 - (level_id - 1)*2
-    # grid_size_x = random.randint(1, 10)*5
-    max_effective_moves = 15 + 5 * (level_id-1)
-    # brightness = 1.0 - (level_id - 1) / levels_to_win
-    brightness = 1.0
-
-    async with generated_levels_lock:  # probably not needed
-        if level_id > len(generated_levels):
-            min_ratio = min(x.level_size_ratio for x in remote_player_infos.values())
-            grid_size_y = int(grid_size_x*min_ratio)
-
-            samples = [
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate(),
-                LevelGenerator.Generator(grid_size_x, grid_size_y, max_effective_moves).generate()
-            ]
-
-            # get level with the most effective moves
-            level = max(samples, key=lambda x: x[1])[0]
-            level_str = ''.join(str(x) for x in level)
-            generated_levels.append(level_str)
-            level_id = len(generated_levels)
-        else:
-            level_str = generated_levels[level_id - 1]
-
-    return level_id, level_str, grid_size_x, brightness
-
-
-class ResultMessage(NamedTuple):
-    message: str
-    bg_style: str
-    fg_style: str
 
-    def to_message(self, players_left):
-        message = self.message
-        if players_left > 0:
-            message += f"\n{players_left} players left"
-        else:
-            message += "\nGame complete"
-        return create_message(message, self.bg_style, self.fg_style)
-
-
-class PlayerInfo:
-    def __init__(self, name: str, ws: WebSocketResponse):
-        self.name = name
-        self.socket = ws
-        self.level_size_ratio = 1.0
-        self.level = 0
-        self.level_progress = 0.0
-        self.last_progress_message = ""
-        self.is_ready = False
-        self.result_message: Optional[ResultMessage] = None
-
-
-leaderboard_listeners = []
-
-leaderboard_results_json: Optional[str] = None
+from Commands import CommandDispatcher, message_text, parse_register_player
+from common import positive_float, positive_int
+from Diagnostics import profiler, watchdog
+from GameManager import game_manager, new_lobby_code, normalize_lobby_code
+from GameSession import GameSession, PlayerInfo
+from GenerationExecutor import generation_executor, watch_parent, SamplingStrategy
+from LevelLibrary import LevelLibrary
+from LobbyRouter import LobbyRouter, client_remote, worker_for_lobby
+from Messages import create_message
+from Metrics import metrics, CONTENT_TYPE
+from OutboundQueue import OutboundQueue
+from StaticAssets import static_assets
+
+# set in lobby worker processes, the router in front of them passes on the address of the actual client
+behind_router = False
+
+# bearer token for the /admin/ endpoints, they don't exist without one
+admin_token: Optional[str] = None
+
+# seconds the router gives its lobby workers to stop, they wait for the level samples they're generating
+WORKER_STOP_TIMEOUT = 10.0
+
+
+# the protocol is ascii apart from player names, so characters of text frames are counted as bytes
+RECEIVED_BYTES = metrics.counter("colorfill_received_bytes_total", "bytes received on websockets", ("endpoint",))
+PLAYER_RECEIVED_BYTES = RECEIVED_BYTES.labels("player")
+LEADERBOARD_RECEIVED_BYTES = RECEIVED_BYTES.labels("leaderboard")
+
+
+class PlayerConnection:
+    # the context the command handlers get, bound to its player record once at registration
+    def __init__(self, request: Request, outbound: OutboundQueue, session: GameSession):
+        self.remote = client_remote(request, behind_router)
+        self.outbound = outbound
+        self.session = session
+        self.bound_player: Optional[PlayerInfo] = None
+
+    @property
+    def player_info(self) -> Optional[PlayerInfo]:
+        # None once the player is out of the session or continued on another socket
+        player_info = self.bound_player
+        if player_info is None or not player_info.registered or player_info.outbound is not self.outbound:
+            return None
+        return player_info
 
+    def __str__(self):
+        player_info = self.player_info
+        if player_info is not None:
+            return f"{player_info.name}({self.remote}) in {self.session}"
+        return f"{self.remote} in {self.session}"
 
-async def send_to_all_players(message: str | Callable[[PlayerInfo], Optional[str]]):
-    player: PlayerInfo
-    for key, player in list(remote_player_infos.items()):
-        if player.socket.closed:
-            print("Closed connection with", player.name)
-            del remote_player_infos[key]
-            continue
 
-        if isinstance(message, str):
-            await player.socket.send_str(message)
-        else:
-            _message = message(player)
-            if _message is not None:
-                await player.socket.send_str(_message)
+commands = CommandDispatcher()
 
 
-def create_level_message(level_id, level_name: str, grid_size_x: int, brightness: float, level_str: str):
-    return f"level:{level_id};{level_name};{grid_size_x};{brightness};{level_str}"
+@commands.command("RegisterPlayer")
+async def register_player(connection: PlayerConnection, data: str):
+    player_info = await connection.session.register_player(connection.outbound, parse_register_player(data))
+    if player_info is not None:
+        connection.bound_player = player_info
 
 
-def create_lobby_message(players: Iterable[Tuple[str, bool]]):
-    players_str = "\n".join(name+("+" if ready else "-") for name, ready in players)
-    return f"lobby:{players_str}"
+@commands.command("AnnounceReady")
+async def announce_ready(connection: PlayerConnection, _data: str):
+    player_info = connection.player_info
+    if player_info is not None:
+        await connection.session.announce_ready(player_info)
 
 
-def create_message(message, bg_style="#000", fg_style="#fff"):
-    return f"message:{bg_style};{fg_style};{message}"
+@commands.command("AnnounceDone")
+async def announce_done(connection: PlayerConnection, _data: str):
+    player_info = connection.player_info
+    if player_info is not None:
+        await connection.session.announce_done(player_info)
 
 
-def create_overlay_message(message, style="#fff", display_time=1.0, animation="none"):
-    return f"overlay_message:{display_time};{animation};{style};{message}"
+@commands.command("AnnounceProgress")
+def announce_progress(connection: PlayerConnection, data: str):
+    player_info = connection.player_info
+    if player_info is not None:
+        connection.session.announce_progress(player_info, data)
 
 
-async def end_game():
-    def message(p: PlayerInfo):
-        if p.result_message is not None:
-            return p.result_message.to_message(0)
-        else:
-            return None
+@commands.command("AnnounceProgressDelta")
+def announce_progress_delta(connection: PlayerConnection, data: str):
+    player_info = connection.player_info
+    if player_info is not None:
+        connection.session.announce_progress_delta(player_info, data)
 
-    await send_to_all_players(message)
 
-    remote_player_infos.clear()
-    generated_levels.clear()
+def lobby_code(request: Request):
+    return normalize_lobby_code(request.query.get("lobby", ""))
 
 
-def update_leaderboard_results():
-    info: PlayerInfo
-    results = [
-        [info.name, info.level, info.level_progress, info.last_progress_message]
-        for info in remote_player_infos.values()
-    ]
+async def websocket_handler(request: Request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
 
-    results.sort(key=lambda x: x[1] + x[2], reverse=True)
+    code = lobby_code(request)
+    if code is None:
+        await ws.send_str(create_message("Invalid\nlobby code", bg_style="#400", fg_style="#fcc"))
+        await ws.close()
+        return ws
+
+    outbound = OutboundQueue(ws)
+    session = game_manager.connect(code)
+    connection = PlayerConnection(request, outbound, session)
+
+    try:
+        msg: WSMessage
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                print('ws connection closed with exception %s' % ws.exception())
+                continue
 
-    for entry in results:
-        if entry[1] == levels_to_win:
-            entry[1] = "F"
+            if msg.type == aiohttp.WSMsgType.TEXT or msg.type == aiohttp.WSMsgType.BINARY:
+                PLAYER_RECEIVED_BYTES.inc(len(msg.data))
 
-    global leaderboard_results_json
-    leaderboard_results_json = json.dumps(results)
+            message = message_text(msg)
+            if message is None:
+                continue
 
+            if message == 'close':
+                await ws.close()
+                continue
 
-def ready_players_count():
-    return sum(1 for p in remote_player_infos.values() if p.is_ready)
+            await commands.dispatch(connection, message)
+    finally:
+        outbound.close()
+        game_manager.disconnect(session)
 
+    return ws
 
-def players_done_count():
-    return sum(1 for p in remote_player_infos.values() if p.result_message is not None)
 
+async def websocket_handler_leaderboard(request: Request):
+    code = lobby_code(request)
+    if code is None:
+        return web.Response(status=400, text="invalid lobby code")
 
-async def websocket_handler(request: Request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    outbound = OutboundQueue(ws)
+
+    session = game_manager.connect(code)
+    leaderboard = session.leaderboard
+
+    delta = request.query.get("protocol") == "delta"
+    if delta:
+        leaderboard.add_delta_listener(outbound)
+    else:
+        leaderboard.add_listener(outbound)
+
+    try:
+        msg: WSMessage
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT or msg.type == aiohttp.WSMsgType.BINARY:
+                LEADERBOARD_RECEIVED_BYTES.inc(len(msg.data))
+                if delta and message_text(msg) == "resync":
+                    leaderboard.resync(outbound)
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                print('ws connection closed with exception %s' % ws.exception())
+    finally:
+        outbound.close()
+        game_manager.disconnect(session)
 
-    msg: WSMessage
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            if msg.data == 'close':
-                await ws.close()
-                continue
+    return ws
 
-            player_info = remote_player_infos.get(request.remote, None)
-            if player_info is not None:
-                origin = f"{player_info.name}({request.remote})"
-            else:
-                origin = request.remote
-
-            print("received", msg.data, "from", origin)
-
-            player_info: PlayerInfo = remote_player_infos.get(request.remote, None)
-
-            p: PlayerInfo
-            all_players_ready = ready_players_count() == len(remote_player_infos)
-
-            if ready_players_count() == 0:
-                all_players_ready = False
-
-            match = re.match("^([a-zA-Z0-9_]*):(.*)$", msg.data)
-            if match:
-                command, data = match.groups()
-
-                def lobby_message(self_p: PlayerInfo):
-                    return create_lobby_message(
-                        (p.name, p.is_ready) for p in remote_player_infos.values() if p is not self_p
-                    )
-
-                if command == "RegisterPlayer":
-                    if player_info is not None and player_info.result_message is not None:
-                        await ws.send_str(player_info.result_message.to_message(
-                            len(remote_player_infos) - players_done_count()
-                        ))
-                        continue
-
-                    match = re.match(r"^(.*){(.*)}$", data)
-                    if match:
-                        player_name, extra_infos = match.groups()
-
-                        if all_players_ready and player_info is not None:
-                            level_id, level_str, grid_size_x, brightness = await get_level(max(1, player_info.level))
-                            player: PlayerInfo
-                            await ws.send_str(
-                                create_level_message(level_id, f"Level {level_id}",grid_size_x,brightness,level_str)
-                            )
-                            continue
-                        elif all_players_ready and player_info is None:
-                            await ws.send_str(
-                                create_message(
-                                    "Game already\nin progress",
-                                    bg_style="#400", fg_style="#fcc"
-                                )
-                            )
-                            continue
-
-                        if player_info is None:
-                            player_info = PlayerInfo(player_name, ws)
-                            player_info.is_ready = all_players_ready
-                            remote_player_infos[request.remote] = player_info
-                        elif player_info.socket.closed:
-                            player_info.socket = ws
-                        else:
-                            player_info.name = player_name
-
-                        for pair in extra_infos.split(";"):
-                            key, value = pair.split("=", 1)
-
-                            if key == "levelSizeRatio":
-                                player_info.level_size_ratio = float(value)
-
-                        await send_to_all_players(lobby_message)
-
-                elif command == "AnnounceReady":
-                    was_all_players_ready = all_players_ready
-                    player_info.is_ready = True
-                    all_players_ready = all(p.is_ready for p in remote_player_infos.values())
-
-                    if not was_all_players_ready and all_players_ready:
-                        level_id, level_str, grid_size_x, brightness = await get_level(1)
-                        player: PlayerInfo
-
-                        await send_to_all_players(
-                            create_level_message(level_id, f"Level {level_id}", grid_size_x, brightness, level_str)
-                        )
-
-                        for player in remote_player_infos.values():
-                            player.level = level_id
-                    else:
-                        await send_to_all_players(lobby_message)
-
-                elif command == "AnnounceDone" and player_info is not None:
-                    player_info.level += 1
-                    level_id, level_str, grid_size_x, brightness = await get_level(player_info.level)
-
-                    if level_id == levels_to_win+1:
-                        player_info.level -= 1
-                        player_info.level_progress = 1.0
-
-                        players_done = players_done_count()
-
-                        match players_done:
-                            case 0:
-                                player_info.result_message = ResultMessage("You are #1!", "#631", "#fc4")
-
-                                def message(p):
-                                    if p == player_info:
-                                        return None
-                                    else:
-                                        return create_overlay_message(
-                                            f"{player_info.name} is already done\nHurry up!",
-                                            display_time=2.0, animation="fly-in"
-                                        )
-
-                                await send_to_all_players(message)
-
-                                asyncio.ensure_future(count_down(5.0, 30))
-                            case 1:
-                                player_info.result_message = ResultMessage("You are #2", "#334", "#eef4ff")
-                            case 2:
-                                player_info.result_message = ResultMessage("You are #3", "#521", "#fa7")
-                            case _:
-                                player_info.result_message = ResultMessage(f"You are #{players_done + 1}",
-                                                                           "#034", "#cfd")
-
-                        players_left = len(remote_player_infos) - players_done_count()
-
-                        def message(p: PlayerInfo):
-                            if p.result_message is not None:
-                                return p.result_message.to_message(players_left)
-                            else:
-                                return None
-
-                        await send_to_all_players(message)
-
-                        update_leaderboard_results()
-
-                        if players_done_count() == len(remote_player_infos):
-                            await end_game()
-
-                        continue
-
-                    await ws.send_str(
-                        create_level_message(level_id, f"Level {level_id}", grid_size_x, brightness, level_str)
-                    )
-
-                elif command == "AnnounceProgress" and player_info is not None:
-                    match = re.match("^(\\d+);(\\d+);(.*)$", data)
-                    if match:
-                        grid_size_x = int(match[1])
-                        grid_size_y = int(match[2])
-                        compressed_level_bytes = np.frombuffer(base64.b64decode(match[3]), dtype='uint8')
 
-                        level_bytes = np.zeros(shape=(len(compressed_level_bytes), 4), dtype='uint8')
+async def metrics_handler(_request: Request):
+    # the metrics of this process, lobby workers have their own on their ports
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
 
-                        level_bytes[:, 0] |= compressed_level_bytes & 0b11
-                        level_bytes[:, 1] |= (compressed_level_bytes >> 2) & 0b11
-                        level_bytes[:, 2] |= (compressed_level_bytes >> 4) & 0b11
-                        level_bytes[:, 3] |= (compressed_level_bytes >> 6)
 
-                        empty_count = np.count_nonzero(level_bytes == 0)
-                        filled_count = np.count_nonzero(level_bytes == 2)
+def is_admin(request: Request):
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if admin_token is None or scheme != "Bearer":
+        return False
+    # as bytes, compare_digest only takes ascii strs, headers and argv can have undecodable bytes in them
+    return secrets.compare_digest(token.encode("utf-8", "surrogateescape"),
+                                  admin_token.encode("utf-8", "surrogateescape"))
 
-                        player_info.level_progress = filled_count / (empty_count+filled_count)
-                        player_info.last_progress_message = data
 
-                        update_leaderboard_results()
+async def profile_handler(request: Request):
+    # /admin/profile?seconds=10&interval=0.005&threads=all, answers with collapsed stacks for flamegraph.pl,
+    # speedscope and the like, only the event loop thread unless threads=all
+    if admin_token is None:
+        return web.Response(status=404)
+    if not is_admin(request):
+        return web.Response(status=403)
 
-        elif msg.type == aiohttp.WSMsgType.ERROR:
-            print('ws connection closed with exception %s' % ws.exception())
+    try:
+        seconds = float(request.query.get("seconds", 10.0))
+        interval = float(request.query.get("interval", 0.005))
+    except ValueError:
+        return web.Response(status=400, text="seconds and interval have to be numbers")
+    if not interval > 0:
+        return web.Response(status=400, text="interval has to be positive")
 
-    return ws
+    collapsed = await profiler.capture(seconds, interval, request.query.get("threads") == "all")
+    if collapsed is None:
+        return web.Response(status=409, text="a profile is already being captured")
+    return web.Response(text=collapsed)
 
 
-async def websocket_handler_leaderboard(request: Request):
-    ws = web.WebSocketResponse()
-    await ws.prepare(request)
+async def new_lobby_handler(_request: Request):
+    return web.Response(text=new_lobby_code())
 
-    leaderboard_listeners.append(ws)
 
-    msg: WSMessage
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.ERROR:
-            print('ws connection closed with exception %s' % ws.exception())
+# what the referringPage cookie set by the index pages means for paths outside of /client/ and /leaderboard/
+COOKIE_APPS = {"Client": "client", "Leaderboard": "leaderboard"}
 
-    return ws
 
-
-async def file_handler(path):
-    print(f"loading file {path}")
-    if not os.path.exists(path):
-        print("FAILED")
-        # leaderboard_page_res_path = "Live-Leaderboard/public/"+path
-        # if os.path.exists(leaderboard_page_res_path):
-        #     return await file_handler(leaderboard_page_res_path)
-        # else:
+async def file_response(request: Request, app: str, path: str):
+    asset = static_assets.get(app, path or "index.html")
+    if asset is None:
         return web.Response(status=404)
+    return static_assets.response(request, asset)
 
-    with open(path, 'rb') as file:
-        return web.Response(body=file.read(), content_type=mimetypes.guess_type(path)[0])
 
+def app_file_handler(app: str):
+    async def handler(request: Request):
+        return await file_response(request, app, request.match_info["path"])
+
+    return handler
 
-async def any_file_handler(request: Request):
-    path = request.path[1:]
-    referring_page = request.cookies.get("referringPage")
 
-    if referring_page == "Client":
-        path = "ColorFill-Client/public/" + path
-    elif referring_page == "Leaderboard":
-        path = "Live-Leaderboard/public/" + path
-    return await file_handler(path)
+async def any_file_handler(request: Request):
+    app = COOKIE_APPS.get(request.cookies.get("referringPage"))
+    if app is None:
+        return web.Response(status=404)
+    return await file_response(request, app, request.path[1:])
 
 
-def create_runner():
+def create_runner(router: Optional[LobbyRouter] = None):
     app = web.Application()
     app.add_routes([
-        web.get('/', lambda x: file_handler("ColorFill-Client/public/index.html")),
-        web.get('/leaderboard', lambda x: file_handler("Live-Leaderboard/public/index.html")),
-        web.get('/ws', websocket_handler),
-        web.get('/leaderboard/ws', websocket_handler_leaderboard),
+        web.get('/', lambda request: file_response(request, "client", "index.html")),
+        web.get('/leaderboard', lambda request: file_response(request, "leaderboard", "index.html")),
+        web.get('/lobby/new', new_lobby_handler),
+        web.get('/metrics', metrics_handler),
+        web.get('/admin/profile', profile_handler),
+        web.get('/ws', websocket_handler if router is None else router.websocket_handler),
+        web.get('/leaderboard/ws', websocket_handler_leaderboard if router is None else router.websocket_handler),
+        web.get('/client/{path:.*}', app_file_handler("client")),
+        web.get('/leaderboard/{path:.*}', app_file_handler("leaderboard")),
         web.get('/{tail:.*}', any_file_handler),
     ])
     return web.AppRunner(app)
 
 
-async def start_server(host="0.0.0.0", port=8000):
-    runner = create_runner()
+async def start_server(host="0.0.0.0", port=8000, router: Optional[LobbyRouter] = None):
+    runner = create_runner(router)
     await runner.setup()
     site = web.TCPSite(runner, host, port)
     await site.start()
     print("server started on", host, f"port={port}")
 
 
-async def count_down(delay, number=30):
-    await asyncio.sleep(delay)
-    while number > 10:
-        if players_done_count() == len(remote_player_infos):
-            return
-
-        def message(p: PlayerInfo):
-            if p.result_message is None:
-                return create_overlay_message(f"{number} seconds left!", display_time=2.0,
-                                              animation="fly-in")
+async def start_router(host, port, router: LobbyRouter):
+    await router.wait_for_workers()
+    await start_server(host, port, router)
 
-        await send_to_all_players(message)
 
-        await asyncio.sleep(10)
-        number -= 10
+def start_watchdog(args):
+    watchdog.configure(args.lag_threshold)
+    watchdog.start()
 
-    while number > 0:
-        if players_done_count() == len(remote_player_infos):
-            return
 
-        def message(p: PlayerInfo):
-            if p.result_message is None:
-                if number <= 3:
-                    return create_overlay_message(f"  {number}  ", style="#f88")
-                else:
-                    return create_overlay_message(f"   {number}   ")
+def start_static_assets(args):
+    static_assets.load()
+    if args.asset_reload_interval > 0:
+        asyncio.ensure_future(static_assets.watch(args.asset_reload_interval))
 
-        await send_to_all_players(message)
 
-        await asyncio.sleep(1)
-        number -= 1
+def run_until_stopped(loop: asyncio.AbstractEventLoop):
+    # SIGTERM and Ctrl+C stop the loop instead of killing the process, so the caller gets to clean up
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, loop.stop)
+    loop.run_forever()
+    # the loop isn't going to tick anymore, the watchdog would take the shutdown for a stall
+    watchdog.stop()
+    print("server stopped")
 
-    if players_done_count() == len(remote_player_infos):
-        return
 
-    def message(p: PlayerInfo):
-        if p.result_message is None:
-            return create_message("Game over", bg_style="#300", fg_style="#f00")
+def run_server(args, host, port, owns_lobby: Callable[[str], bool] = lambda code: True):
+    global admin_token
+    admin_token = args.admin_token
 
-    await send_to_all_players(message)
+    if args.level_library is not None:
+        level_library = LevelLibrary(args.level_library)
+    else:
+        level_library = None
 
-    await end_game()
+    game_manager.configure(level_library, args.consume_library_levels, args.leaderboard_rate, args.journal)
 
+    generation_executor.configure(args.generator_workers, args.generator_threads, SamplingStrategy(
+        max_samples=args.samples,
+        target_quality=args.target_quality,
+        time_budget=args.time_budget,
+        stop_on_first_optimal=not args.keep_sampling
+    ))
+    generation_executor.start()
 
-async def publish_results():
-    while True:
-        await asyncio.sleep(0.1)
+    if not behind_router:
+        start_static_assets(args)
+    start_watchdog(args)
 
-        if leaderboard_results_json is not None:
-            for listener in leaderboard_listeners:
-                listener: WebSocketResponse
-                if listener.closed:
-                    continue
-                await listener.send_str(leaderboard_results_json)
+    loop = asyncio.get_event_loop()
+    if args.journal is not None:
+        # runs before the server starts, reconnecting clients already find their sessions
+        loop.call_soon(game_manager.restore, owns_lobby)
+    asyncio.ensure_future(start_server(host, port))
+
+    try:
+        run_until_stopped(loop)
+    finally:
+        generation_executor.shutdown(wait=True)
+
+
+def run_lobby_worker(args, port, parent_pid):
+    global behind_router
+    behind_router = True
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    watch_parent(parent_pid)
+    # all workers share the journal directory, each one restores the lobbies the router sends to it
+    worker_index = port - args.port - 1
+    run_server(args, "127.0.0.1", port,
+               lambda code: worker_for_lobby(code, args.lobby_workers) == worker_index)
+
+
+def run_router(args):
+    global admin_token
+    admin_token = args.admin_token
+
+    # every worker gets its own share of the cores for level generation
+    if args.generator_workers is None:
+        args.generator_workers = max(1, (os.cpu_count() or 1) // args.lobby_workers)
+
+    worker_ports = [args.port + 1 + i for i in range(args.lobby_workers)]
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_lobby_worker, args=(args, port, os.getpid())) for port in worker_ports]
+    for worker in workers:
+        worker.start()
+
+    start_static_assets(args)
+    start_watchdog(args)
+    asyncio.ensure_future(start_router(args.host, args.port, LobbyRouter(worker_ports)))
 
-        leaderboard_listeners[:] = [x for x in leaderboard_listeners if not x.closed]
+    loop = asyncio.get_event_loop()
+    try:
+        run_until_stopped(loop)
+    finally:
+        # the workers shut their generation pools down themselves, one that takes too long gets killed
+        for worker in workers:
+            worker.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                print(f"lobby worker {worker.pid} didn't stop in time, killing it")
+                worker.kill()
+                worker.join()
 
 
 if __name__ == "__main__":
-    asyncio.ensure_future(start_server(sys.argv[1], int(sys.argv[2])))
-    asyncio.ensure_future(publish_results())
-
-    loop = asyncio.get_event_loop()
-    loop.run_forever()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default="0.0.0.0")
+    parser.add_argument("port", nargs="?", type=int, default=8000)
+    parser.add_argument("--generator-workers", type=int, default=None,
+                        help="size of the level generation pool (default: one per core, 0: generate inline)")
+    parser.add_argument("--generator-threads", action="store_true",
+                        help="use a thread pool instead of a process pool for level generation")
+    parser.add_argument("--samples", type=positive_int, default=8,
+                        help="maximum number of samples generated per level, the best one is used")
+    parser.add_argument("--target-quality", type=float, default=None,
+                        help="stop sampling once a sample has this fraction of the levels max effective moves")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="stop sampling a level after this many seconds")
+    parser.add_argument("--keep-sampling", action="store_true",
+                        help="take all samples even if one already has the max effective moves")
+    parser.add_argument("--leaderboard-rate", type=positive_float, default=10.0,
+                        help="maximum number of leaderboard updates per second")
+    parser.add_argument("--level-library", default=None,
+                        help="directory of a level library (see LevelLibrary.py) to take levels from")
+    parser.add_argument("--consume-library-levels", action="store_true",
+                        help="mark levels taken from the level library as used so they don't repeat")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="DEBUG logs every received command")
+    parser.add_argument("--lobby-workers", type=int, default=0,
+                        help="run the lobbies in this many worker processes on the following ports, "
+                             "this process only routes the sockets to them (default: run them in here)")
+    parser.add_argument("--asset-reload-interval", type=float, default=0.0,
+                        help="seconds between checks for changed client files, for working on the clients "
+                             "(default: 0, never reload them)")
+    parser.add_argument("--journal", default=None,
+                        help="directory for game journals, games are restored from them when the server restarts "
+                             "(default: no journals)")
+    parser.add_argument("--lag-threshold", type=float, default=0.1,
+                        help="log the stack of the event loop when it's blocked for longer than this many seconds "
+                             "(0: no watchdog)")
+    parser.add_argument("--admin-token", default=os.environ.get("COLORFILL_ADMIN_TOKEN"),
+                        help="bearer token for /admin/profile (default: $COLORFILL_ADMIN_TOKEN, unset: no admin "
+                             "endpoints)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+
+    if args.lobby_workers > 0:
+        run_router(args)
+    else:
+        run_server(args, args.host, args.port)
@@ -0,0 +1,176 @@
+import asyncio
+import base64
+
+import Journal
+from GameSession import GameSession
+from OutboundQueue import DetachedOutbound
+
+# 0b10101010, four filled tiles
+FILLED_BYTE = bytes([0b10101010])
+
+
+def records_of(*records: bytes):
+    return Journal.MAGIC + b"".join(records)
+
+
+def decode(data: bytes):
+    records, intact = Journal.decode_records(data, len(data))
+    return records, intact
+
+
+def test_every_record_type_round_trips():
+    encoded = [
+        Journal.REGISTER.encode(3, 0.7, True, "3-secret", "Ünïcode name"),
+        Journal.READY.encode(3),
+        Journal.LEVEL.encode(1, 15, 360, 1.0, 1.6, bytes(90)),
+        Journal.LEVELS_RESET.encode(),
+        Journal.ADVANCE.encode(3, 2),
+        Journal.PROGRESS.encode(3, 2, 0.25, 15, 24, 270, 90, FILLED_BYTE * 90),
+        Journal.RESULT.encode(3, "You are #1!", "#631", "#fc4"),
+        Journal.REMOVE.encode(3),
+    ]
+    data = records_of(*encoded)
+
+    records, intact = decode(data)
+    assert intact == len(data)
+    assert records == [
+        (Journal.REGISTER, (3, 0.7, True, "3-secret", "Ünïcode name")),
+        (Journal.READY, (3,)),
+        (Journal.LEVEL, (1, 15, 360, 1.0, 1.6, bytes(90))),
+        (Journal.LEVELS_RESET, ()),
+        (Journal.ADVANCE, (3, 2)),
+        (Journal.PROGRESS, (3, 2, 0.25, 15, 24, 270, 90, FILLED_BYTE * 90)),
+        (Journal.RESULT, (3, "You are #1!", "#631", "#fc4")),
+        (Journal.REMOVE, (3,)),
+    ]
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    first = Journal.READY.encode(1)
+    second = Journal.ADVANCE.encode(1, 2)
+    path = tmp_path / "lobby-A.journal"
+    path.write_bytes(records_of(first, second)[:-3])
+
+    assert Journal.read_journal(str(path)) == [(Journal.READY, (1,))]
+
+
+def test_crc_mismatch_ends_the_journal():
+    second = bytearray(Journal.ADVANCE.encode(1, 2))
+    second[Journal.HEADER.size] ^= 0xff
+    data = records_of(Journal.READY.encode(1), bytes(second), Journal.READY.encode(2))
+
+    records, intact = decode(data)
+    assert records == [(Journal.READY, (1,))]
+    assert intact == len(Journal.MAGIC) + len(Journal.READY.encode(1))
+
+
+def test_other_format_versions_are_not_read():
+    data = b"CFJ\x01" + Journal.READY.encode(1)
+    assert decode(data) == ([], 0)
+
+
+def test_values_that_dont_fit_are_left_out():
+    assert Journal.PROGRESS.try_encode(1, 1, 0.5, 70000, 1, 0, 0, b"") is None
+    assert Journal.READY.try_encode(1) == Journal.READY.encode(1)
+
+
+def test_journal_survives_a_bad_progress_record(tmp_path):
+    path = str(tmp_path / "lobby-A.journal")
+
+    def progress_record(slot):
+        return Journal.PROGRESS.encode(slot, 1, 0.5, 70000, 1, 0, 0, b"")
+
+    async def run():
+        journal = Journal.GameJournal(path, lambda: [], progress_record, flush_interval=0.01)
+        journal.start()
+        # after the first batch, which is always a snapshot
+        await asyncio.sleep(0.02)
+        journal.progress(1, 1)
+        journal.append(Journal.READY.encode(2))
+        await asyncio.sleep(0.02)
+        journal.progress(1, 1)
+        await asyncio.sleep(0.02)
+        journal.append(Journal.READY.encode(3))
+        journal.close()
+        await journal._task
+
+    asyncio.run(run())
+    assert [fields for _, fields in Journal.read_journal(path)] == [(2,), (3,)]
+
+
+def test_discard_leaves_the_journal_of_a_new_session_alone(tmp_path):
+    path = str(tmp_path / "lobby-A.journal")
+
+    async def run():
+        old = Journal.GameJournal(path, lambda: [Journal.READY.encode(1)], lambda _: None, flush_interval=0.05)
+        old.start()
+        await asyncio.sleep(0.01)
+        # the old session closes while it's still waiting for its next batch, the new one opens right away
+        old.close(discard=True)
+        new = Journal.GameJournal(path, lambda: [Journal.READY.encode(2)], lambda _: None, flush_interval=0.05)
+        new.start()
+        await old._task
+        new.close()
+        await new._task
+
+    asyncio.run(run())
+    assert Journal.read_journal(path) == [(Journal.READY, (2,))]
+
+
+def test_discard_deletes_the_journal(tmp_path):
+    path = tmp_path / "lobby-A.journal"
+
+    async def run():
+        journal = Journal.GameJournal(str(path), lambda: [Journal.READY.encode(1)], lambda _: None,
+                                      flush_interval=0.01)
+        journal.start()
+        await asyncio.sleep(0.02)
+        assert path.exists()
+        journal.close(discard=True)
+        await journal._task
+
+    asyncio.run(run())
+    assert not path.exists()
+
+
+def test_restore_brings_players_back():
+    packed = FILLED_BYTE * 2 + bytes(88)
+    records, _ = decode(records_of(
+        Journal.REGISTER.encode(0, 1.6, True, "0-first", "first"),
+        Journal.REGISTER.encode(1, 0.7, False, "1-second", "second"),
+        Journal.REGISTER.encode(2, 1.0, False, "2-gone", "gone"),
+        Journal.READY.encode(0),
+        Journal.READY.encode(1),
+        Journal.ADVANCE.encode(0, 1),
+        Journal.ADVANCE.encode(1, 1),
+        Journal.PROGRESS.encode(0, 1, 8 / 360, 15, 24, 352, 8, packed),
+        # written after the advance that made it stale
+        Journal.ADVANCE.encode(1, 2),
+        Journal.PROGRESS.encode(1, 1, 8 / 360, 15, 24, 352, 8, packed),
+        Journal.REMOVE.encode(2),
+    ))
+
+    async def run():
+        session = GameSession("A")
+        session.restore(records)
+        return session
+
+    session = asyncio.run(run())
+    first, second = session.players.get(0), session.players.get(1)
+    assert len(session.players) == 2 and session.players.get(2) is None
+    assert (first.name, first.token, first.level_size_ratio, first.packed_levels) == ("first", "0-first", 1.6, True)
+    assert (second.token, second.level_size_ratio) == ("1-second", 0.7)
+    assert first.is_ready and second.is_ready
+
+    assert first.level == 1 and first.level_progress == 8 / 360
+    assert first.progress_board.message == f"15;24;{base64.b64encode(packed).decode()}"
+    assert (first.progress_board.empty_count, first.progress_board.filled_count) == (352, 8)
+    assert second.level == 2 and second.progress_board.tiles is None
+
+    assert session.player_for_token("0-first") is first
+    assert session.player_for_token("0-wrong") is None
+    assert session.player_for_token("0-wröng") is None
+    assert session.player_for_token("²-first") is None
+
+    # until their clients reconnect
+    assert isinstance(first.outbound, DetachedOutbound) and not first.outbound.closed
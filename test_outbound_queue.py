@@ -0,0 +1,48 @@
+import asyncio
+
+from OutboundQueue import LEADERBOARD, LEVEL, LOBBY, OVERLAY, OutboundQueue
+
+
+class StalledSocket:
+    # never finishes a send, everything after the first frame stays queued
+    closed = False
+
+    async def send_frame(self, _frame: bytes, _message_type):
+        await asyncio.Event().wait()
+
+
+def queued(queue: OutboundQueue):
+    return [entry.frame for entry in queue._entries]
+
+
+def test_latest_is_kept_when_full_of_reliable():
+    async def run():
+        queue = OutboundQueue(StalledSocket(), max_size=3)
+        for i in range(4):
+            queue.put_str(LEVEL, f"level{i}")
+        await asyncio.sleep(0)
+
+        queue.put_str(LOBBY, "lobby1")
+        queue.put_str(LOBBY, "lobby2")
+        queue.put_str(LEADERBOARD, "leaderboard")
+        assert queued(queue)[-2:] == [b"lobby2", b"leaderboard"]
+        assert queue.has_pending(LOBBY)
+        queue.close()
+
+    asyncio.run(run())
+
+
+def test_latest_evicts_droppable_first():
+    async def run():
+        queue = OutboundQueue(StalledSocket(), max_size=3)
+        queue.put_str(LEVEL, "level0")
+        await asyncio.sleep(0)
+
+        queue.put_str(OVERLAY, "overlay")
+        queue.put_str(LEVEL, "level1")
+        queue.put_str(LEVEL, "level2")
+        queue.put_str(LOBBY, "lobby")
+        assert queued(queue) == [b"level1", b"level2", b"lobby"]
+        queue.close()
+
+    asyncio.run(run())
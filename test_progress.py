@@ -0,0 +1,70 @@
+import base64
+
+import LevelGenerator
+from Progress import count_tiles, parse_progress, ProgressBoard, EMPTY
+
+# 0b10101010, four filled tiles
+FILLED_BYTE = base64.b64encode(bytes([0b10101010])).decode()
+
+
+def empty_board(grid_size_x=15, grid_size_y=24):
+    tiles = [EMPTY] * (grid_size_x * grid_size_y)
+    packed = LevelGenerator.pack_tiles(tiles)
+    board = ProgressBoard()
+    board.load(parse_progress(f"{grid_size_x};{grid_size_y};{base64.b64encode(packed).decode()}"))
+    return board
+
+
+def assert_counts_match(board):
+    assert (board.empty_count, board.filled_count) == count_tiles(bytes(board.tiles),
+                                                                 board.grid_size_x * board.grid_size_y)
+
+
+def test_duplicate_ranges_are_rejected():
+    board = empty_board()
+    for _ in range(5):
+        assert not board.patch(f"{board.version};" + ";".join([f"0,{FILLED_BYTE}"] * 50))
+
+    assert board.filled_count == 0
+    assert board.version == 0
+    assert_counts_match(board)
+
+
+def test_overlapping_ranges_are_rejected():
+    board = empty_board()
+    two_bytes = base64.b64encode(bytes([0b10101010] * 2)).decode()
+    assert not board.patch(f"0;0,{two_bytes};1,{FILLED_BYTE}")
+    assert not board.patch(f"0;3,{FILLED_BYTE};2,{two_bytes}")
+
+    assert board.filled_count == 0
+    assert_counts_match(board)
+
+
+def test_descending_ranges_are_rejected():
+    board = empty_board()
+    assert not board.patch(f"0;5,{FILLED_BYTE};1,{FILLED_BYTE}")
+    assert_counts_match(board)
+
+
+def test_ascending_ranges_are_applied():
+    board = empty_board()
+    assert board.patch(f"0;0,{FILLED_BYTE};1,{FILLED_BYTE};7,{FILLED_BYTE}")
+    assert board.patch(f"1;1,{base64.b64encode(bytes([0])).decode()};8,{FILLED_BYTE}")
+
+    assert board.filled_count == 12
+    assert board.version == 2
+    assert_counts_match(board)
+
+
+def test_non_ascii_digits_are_rejected():
+    packed = base64.b64encode(bytes(90)).decode()
+    assert parse_progress(f"15;24;{packed}") is not None
+    assert parse_progress(f"1²;24;{packed}") is None
+    assert parse_progress(f"15;24;{packed};²;0") is None
+
+
+def test_deltas_with_non_ascii_digits_are_rejected():
+    board = empty_board()
+    assert not board.patch(f"²;0,{FILLED_BYTE}")
+    assert not board.patch(f"0;²,{FILLED_BYTE}")
+    assert board.version == 0